@@ -27,6 +27,8 @@ import pandas as pd
 import numpy as np
 import datetime
 import random
+import threading
+import time
 import json
 import cv2
 import csv
@@ -59,6 +61,120 @@ setup_logger()
 # Otherwise, you need to update the settungs in Runtime -> Change runtime type -> Hardware accelerator
 torch.cuda.is_available()
 
+'''
+# Everything below runs on DEVICE instead of calling .cuda(), so the notebook also works on cpu-only machines.
+# On the cpu the conv models use the channels-last format, which is the faster layout for the cpu convolution
+# kernels. The intra-op threads stay at the torch default (one per physical core), capped at the cpus this process
+# may run on: os.cpu_count() counts the hyperthreads and ignores the affinity / cpuset limits, and the DataLoader
+# workers and pipeline threads need cores as well. Set NUM_THREADS to the best value of benchmark_prediction.
+'''
+def get_available_cpus():
+  return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+MEMORY_FORMAT = torch.contiguous_format
+NUM_THREADS = None
+if DEVICE.type == 'cpu':
+  torch.set_num_threads(NUM_THREADS or min(torch.get_num_threads(), get_available_cpus()))
+  MEMORY_FORMAT = torch.channels_last
+
+'''
+# Lightweight instrumentation of the hot paths
+# profiler.timer(name) is a context manager which records the wall time of a block, and profiler.count(name, n)
+# adds to a counter. With PROFILE = False the timer is a shared no-op object and count returns right away, so
+# both can stay in the inner loops. The GPU runs asynchronously, with sync = True the timers wait for the device
+# so that the time is charged to the block which queued the work.
+# summary() gives the count, total, mean and max time of every timer and the counters, save_summary writes it as
+# JSON and save_trace writes the first max_events timed blocks as a Chrome trace (chrome://tracing or ui.perfetto.dev).
+# DEBUG_VIS = False turns off the cv2_imshow / print debug output inside the training and prediction loops.
+# RUN_BENCHMARKS = True runs the standalone micro-benchmarks (e.g. benchmark_rle), which take a while on the cpu.
+'''
+PROFILE = False
+DEBUG_VIS = False
+RUN_BENCHMARKS = False
+
+class NullTimer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+class Timer:
+  __slots__ = ('profiler', 'name', 'start')
+
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    if self.profiler.sync:
+      torch.cuda.synchronize()
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    if self.profiler.sync:
+      torch.cuda.synchronize()
+    self.profiler.record(self.name, self.start, time.perf_counter())
+    return False
+
+class Profiler:
+  NULL_TIMER = NullTimer()
+
+  def __init__(self, enabled=True, sync=False, max_events=100000):
+    self.enabled = enabled
+    self.sync = sync and torch.cuda.is_available()
+    self.max_events = max_events
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.origin = time.perf_counter()
+    self.timers = {}
+    self.counters = {}
+    self.events = []
+
+  def timer(self, name):
+    return Timer(self, name) if self.enabled else self.NULL_TIMER
+
+  def count(self, name, n=1):
+    if self.enabled:
+      with self.lock:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+  def record(self, name, start, end):
+    with self.lock:
+      stats = self.timers.setdefault(name, [0, 0., 0.])
+      stats[0] += 1
+      stats[1] += end - start
+      stats[2] = max(stats[2], end - start)
+      if len(self.events) < self.max_events:
+        self.events.append((name, start, end, threading.get_ident()))
+
+  def summary(self):
+    with self.lock:
+      timers = {name: {"count": count, "total_seconds": total, "mean_ms": 1000 * total / count, "max_ms": 1000 * slowest}
+                for name, (count, total, slowest) in sorted(self.timers.items(), key=lambda t: -t[1][1])}
+      return {"timers": timers, "counters": dict(self.counters)}
+
+  def save_summary(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.summary(), f, indent=2)
+
+  def save_trace(self, path):
+    with self.lock:
+      threads = {ident: k for k, ident in enumerate(dict.fromkeys(ident for _, _, _, ident in self.events))}
+      trace = [{"name": name, "ph": "X", "pid": 0, "tid": threads[ident],
+                "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6}
+               for name, start, end, ident in self.events]
+      trace += [{"name": name, "ph": "C", "pid": 0, "ts": (time.perf_counter() - self.origin) * 1e6,
+                 "args": {name: value}} for name, value in self.counters.items()]
+    with open(path, 'w') as f:
+      json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+profiler = Profiler(PROFILE)
+
 # You need to mount your google drive in order to load the data:
 from google.colab import drive
 drive.mount('/content/drive', True)
@@ -77,68 +193,213 @@ drive.mount('/content/drive', True)
 # Other values could be obtained from the image files.
 '''
 
-def get_detection_data(set_name): 
-  test_dirs = '{}/data/test'.format(BASE_DIR)
-
-  if set_name == 'test':
-
-    dataset = []
-    for i in os.listdir(test_dirs):
-      test = {}
-      filename = os.path.join(test_dirs, i)
-      width, height = Image.open(filename).size
-      test["file_name"] = filename
-      test["width"] = width
-      test["height"] = height
-      test["annotations"] = []
-      dataset.append(test)
-
-    return dataset
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+import copy
 
-  else:
-    data_dirs = '{}/data'.format(BASE_DIR)
-    train_dirs = '{}/data/train'.format(BASE_DIR)
-    
-    dataset = []
-    objects = []
-    file = os.path.join(data_dirs, "train.json")
-    with open(file) as f:
-      imgs_anns = json.load(f)
+'''
+# Image I/O
+# get_image_size below only parses the file header. read_image(filename, scale) decodes at 1/2, 1/4 or 1/8 of
+# the size with cv2.IMREAD_REDUCED_COLOR_*, libjpeg scales a JPEG in the DCT so the full-size image is never built
+# (other formats are decoded and then downscaled by OpenCV).
+# read_image_region decodes the box (x, y, w, h) of an image: a non-interlaced PNG is decoded row by row by PIL,
+# and the decoding stops after the last row of the box. Other formats, and any PIL version where the truncation
+# fails, are decoded whole through image_cache.
+# SceneReader stands in for the image of a large scene (shape and [rows, cols] slices) and reads it by bands of
+# band_rows rows with the same PNG truncation, keeping only the current band, so it should be read from the top
+# down. The rows above a band are still decoded and dropped, a format which can not be truncated is decoded whole
+# once (not into image_cache).
+# image_cache is a thread-safe LRU of decoded images, bounded by max_bytes and shared by the detector, the
+# segmentation and PlaneDataset, so an image which goes through several stages is only decoded once. The cached
+# arrays are shared and must not be modified in place.
+'''
+from collections import OrderedDict
+
+REDUCED_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def read_image(filename, scale=1):
+  image = cv2.imread(filename, REDUCED_FLAGS[scale])
+  assert image is not None, "cannot decode {}".format(filename)
+  return image
+
+class ImageCache:
+  def __init__(self, max_bytes=2**30):
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    with self.lock:
+      self.images = OrderedDict()
+      self.bytes = 0
+
+  def get(self, filename, scale=1):
+    with self.lock:
+      image = self.images.get((filename, scale))
+      if image is not None:
+        self.images.move_to_end((filename, scale))
+    profiler.count('image_cache_hits' if image is not None else 'image_cache_misses')
+    return image
+
+  def put(self, filename, scale, image):
+    with self.lock:
+      if (filename, scale) in self.images or image.nbytes > self.max_bytes:
+        return
+      self.images[(filename, scale)] = image
+      self.bytes += image.nbytes
+      while self.bytes > self.max_bytes:
+        _, evicted = self.images.popitem(last=False)
+        self.bytes -= evicted.nbytes
+
+  def read(self, filename, scale=1):
+    image = self.get(filename, scale)
+    if image is None:
+      # two threads may decode the same image at once, the second put is ignored
+      image = read_image(filename, scale)
+      self.put(filename, scale, image)
+    return image
+
+image_cache = ImageCache()
+
+def read_png_region(filename, x, y, w, h):
+  with Image.open(filename) as img:
+    if img.format == 'PNG' and not img.info.get('interlace') and img.mode in ('RGB', 'RGBA', 'L', 'P') \
+        and len(img.tile) == 1:
+      codec, _, offset, args = img.tile[0][:4]
+      bottom = min(y + h, img.size[1])
+      img.tile = [(codec, (0, 0, img.size[0], bottom), offset, args)]
+      img._size = (img.size[0], bottom)
+      region = np.asarray(img.convert('RGB'))[y:y+h, x:x+w, ::-1]
+      return np.ascontiguousarray(region)
+  return None
+
+def read_image_region(filename, x, y, w, h):
+  image = image_cache.get(filename)
+  if image is None:
+    try:
+      region = read_png_region(filename, x, y, w, h)
+    except Exception:
+      # the truncation relies on PIL internals (img.tile, img._size), on any error the image is decoded whole
+      region = None
+    if region is not None:
+      return region
+    image = read_image(filename)
+    image_cache.put(filename, 1, image)
+  return image[y:y+h, x:x+w]
+
+class SceneReader:
+  def __init__(self, filename, height, width, band_rows=1024):
+    self.filename = filename
+    self.shape = (height, width, 3)
+    self.band_rows = band_rows
+    self.band = None
+    self.band_y = 0
+    self.image = None # the whole image, for the formats which can not be read by rows
+
+  def __getitem__(self, index):
+    rows, cols = index if isinstance(index, tuple) else (index, slice(None))
+    y0, y1, step = rows.indices(self.shape[0])
+    assert step == 1, "only contiguous rows can be read"
+    if self.image is not None:
+      return self.image[rows, cols]
+    if self.band is None or y0 < self.band_y or y1 > self.band_y + len(self.band):
+      self.read_band(y0, max(y1 - y0, self.band_rows))
+      if self.image is not None:
+        return self.image[rows, cols]
+    return self.band[y0-self.band_y:y1-self.band_y, cols]
+
+  def read_band(self, y, h):
+    self.band = None # the previous band is released before the next one is decoded
+    with profiler.timer('decode'):
+      try:
+        self.band = read_png_region(self.filename, 0, y, self.shape[1], h)
+      except Exception:
+        self.band = None
+      if self.band is None:
+        self.image = read_image(self.filename)
+    self.band_y = y
 
-    dataset_dicts = []
-    currfilename = ''
-    for idx, v in enumerate(tqdm(imgs_anns)):
+'''
+# Decode time per image of the full image, of the reduced sizes and of the annotated boxes read one by one
+'''
+def benchmark_image_io(data_list, num_images=20):
+  data_list = [d for d in data_list[:num_images] if d['annotations']]
+  reads = {'full': lambda d: read_image(d['file_name'])}
+  reads.update({'1/{}'.format(s): (lambda d, s=s: read_image(d['file_name'], s)) for s in (2, 4, 8)})
+  reads['boxes'] = lambda d: [read_image_region(d['file_name'], *[max(int(v), 0) for v in a['bbox']])
+                             for a in d['annotations']]
+  for name, read in reads.items():
+    image_cache.clear()
+    start = time.perf_counter()
+    for d in data_list:
+      read(d)
+    print("{:6s}: {:8.1f} ms/image".format(name, 1000 * (time.perf_counter() - start) / max(len(data_list), 1)))
 
-      prevfilename = currfilename      
-      currfilename = os.path.join(train_dirs, v["file_name"])
+'''
+# The image sizes are read from the file headers in a thread pool (PIL does not decode the pixels in Image.open),
+# the annotations are grouped by file name with a dict, so train.json does not need to be sorted.
+# The resulting dataset is saved to data/.<set>_detection_cache.pkl together with the size and mtime of every
+# input file, and it is loaded from there as long as none of the files has changed.
+'''
 
-      record = {}
+def get_image_size(filename):
+  with Image.open(filename) as img:
+    return img.size
+
+def get_file_stats(filenames):
+  stats = {}
+  for filename in filenames:
+    st = os.stat(filename)
+    stats[filename] = (st.st_size, st.st_mtime_ns)
+  return stats
+
+def get_detection_data(set_name, use_cache=True, num_threads=16): 
+  set_name = 'test' if set_name == 'test' else 'train'
+  data_dirs = '{}/data'.format(BASE_DIR)
+  image_dirs = '{}/data/{}'.format(BASE_DIR, set_name)
+  json_file = os.path.join(data_dirs, "train.json")
+  cache_file = os.path.join(data_dirs, '.{}_detection_cache.pkl'.format(set_name))
+
+  filenames = [os.path.join(image_dirs, i) for i in os.listdir(image_dirs)]
+  key = get_file_stats(filenames + ([json_file] if set_name == 'train' else []))
+  if use_cache and os.path.exists(cache_file):
+    with open(cache_file, 'rb') as f:
+      cache = pickle.load(f)
+    if cache['key'] == key:
+      return cache['dataset']
 
-      if currfilename != prevfilename:
-        objects = []
-        img = Image.open(currfilename)
-        width, height =  img.size
-        record["file_name"] = currfilename
-        record["image_id"] = idx
-        record["height"] = height
-        record["width"] = width   
-        dataset.append(record)    
+  if set_name == 'test':
+    dataset = [{"file_name": filename, "annotations": []} for filename in filenames]
 
+  else:
+    with open(json_file) as f:
+      imgs_anns = json.load(f)
 
-      obj =  {
+    records = {}
+    for idx, v in enumerate(imgs_anns):
+      filename = os.path.join(image_dirs, v["file_name"])
+      if filename not in records:
+        records[filename] = {"file_name": filename, "image_id": idx, "annotations": []}
+      records[filename]["annotations"].append({
           "bbox": v["bbox"],
           "bbox_mode": BoxMode.XYWH_ABS,      
           "segmentation": v["segmentation"],
           "category_id": 0,
-      }
-      objects.append(obj)
-      record["annotations"] = objects
-      
+      })
+    dataset = list(records.values())
 
-    
-      
-        
-    return dataset
+  with ThreadPoolExecutor(num_threads) as pool:
+    sizes = list(pool.map(get_image_size, [record["file_name"] for record in dataset]))
+  for record, (width, height) in zip(dataset, sizes):
+    record["width"] = width
+    record["height"] = height
+
+  if use_cache:
+    with open(cache_file + '.tmp', 'wb') as f:
+      pickle.dump({'key': key, 'dataset': dataset}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + '.tmp', cache_file)
+  return dataset
 
 '''
 # Remember to add your dataset to DatasetCatalog and MetadataCatalog
@@ -158,18 +419,35 @@ for d in ["train", "test"]:
 
 plane_train_metadata = MetadataCatalog.get("airplane_train")
 plane_test_metadata = MetadataCatalog.get("airplane_test")
+if RUN_BENCHMARKS:
+  benchmark_image_io(data_train)
 
 '''
 # Visualize some samples using Visualizer to make sure that the function works correctly
+# The samples are drawn at half the size: the image is decoded at 1/2 by read_image and the annotations are
+# scaled with it, instead of decoding the full image and letting the Visualizer downscale it.
 '''
 
+def scale_dataset_dict(d, scale):
+  height, width = d['height'], d['width']
+  annotations = []
+  for a in d['annotations']:
+    segmentation = a['segmentation']
+    if isinstance(segmentation, list):
+      segmentation = [[v * scale for v in p] for p in segmentation]
+    else:
+      mask = detectron2.utils.visualizer.GenericMask(segmentation, height, width).mask
+      segmentation = cv2.resize(mask, (round(width * scale), round(height * scale)), interpolation = cv2.INTER_NEAREST)
+    annotations.append(dict(a, bbox=[v * scale for v in a['bbox']], segmentation=segmentation))
+  return dict(d, height=round(height * scale), width=round(width * scale), annotations=annotations)
+
 i = 0
 for d in random.sample(data_train, 3):
   
-    img = cv2.imread(d["file_name"])
+    img = read_image(d["file_name"], 2)
     
-    visualizer = Visualizer(img[:, :, ::-1], metadata=plane_train_metadata, scale=0.5)
-    out = visualizer.draw_dataset_dict(d)
+    visualizer = Visualizer(img[:, :, ::-1], metadata=plane_train_metadata, scale=1.)
+    out = visualizer.draw_dataset_dict(scale_dataset_dict(d, 1/2))
     cv2_imshow(out.get_image()[:, :, ::-1])
 
 """### Set Configs"""
@@ -191,6 +469,7 @@ cfg.SOLVER.IMS_PER_BATCH = 2
 cfg.SOLVER.MAX_ITER = 700
 cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 512   
 cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1
+cfg.MODEL.DEVICE = DEVICE.type
 
 """### Training"""
 
@@ -213,20 +492,87 @@ cfg.MODEL.WEIGHTS = os.path.join("/content/drive/My Drive/SFU_CMPT_CV_Lab3/outpu
 cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.4
 predictor = DefaultPredictor(cfg)
 
+'''
+# Batched version of the DefaultPredictor
+# A list of images is preprocessed like DefaultPredictor.__call__ does and run as one batch through the model.
+# iter_batches decodes and preprocesses the next batch in a thread pool while the model runs on the current one.
+# detect() skips the images rejected by tile_filter.accept_images, they get None instead of an output.
+'''
+
+class BatchPredictor:
+  def __init__(self, predictor, batch_size=4, num_workers=4):
+    self.model = predictor.model
+    self.aug = predictor.aug
+    self.input_format = predictor.input_format
+    self.batch_size = batch_size
+    self.num_workers = num_workers
+
+  def preprocess(self, image):
+    if self.input_format == "RGB":
+      image = image[:, :, ::-1]
+    height, width = image.shape[:2]
+    tensor = self.aug.get_transform(image).apply_image(image)
+    tensor = torch.as_tensor(tensor.astype("float32").transpose(2, 0, 1))
+    return {"image": tensor, "height": height, "width": width}
+
+  def prepare(self, image):
+    with profiler.timer('preprocess'):
+      return image, self.preprocess(image)
+
+  def load(self, filename):
+    with profiler.timer('decode'):
+      image = image_cache.read(filename)
+    return self.prepare(image)
+
+  def run(self, inputs):
+    self.model.eval()
+    profiler.count('images', len(inputs))
+    with torch.inference_mode(), profiler.timer('detect'):
+      return self.model(inputs)
+
+  def __call__(self, images):
+    return self.run([self.preprocess(image) for image in images])
+
+  def detect(self, images, inputs=None, tile_filter=None):
+    keep = tile_filter.accept_images(images) if tile_filter is not None else [True] * len(images)
+    inputs = inputs if inputs is not None else [None] * len(images)
+    batch = [inputs_i if inputs_i is not None else self.preprocess(image)
+             for image, inputs_i, k in zip(images, inputs, keep) if k]
+    outputs = iter(self.run(batch) if batch else [])
+    return [next(outputs) if k else None for k in keep]
+
+  def iter_batches(self, filenames):
+    batches = [filenames[k:k+self.batch_size] for k in range(0, len(filenames), self.batch_size)]
+    with ThreadPoolExecutor(self.num_workers) as pool:
+      pending = [pool.submit(self.load, f) for f in batches[0]] if batches else []
+      for n in range(len(batches)):
+        loaded = [future.result() for future in pending]
+        if n + 1 < len(batches):
+          pending = [pool.submit(self.load, f) for f in batches[n+1]]
+        images = [image for image, _ in loaded]
+        yield images, self.detect(images, [inputs for _, inputs in loaded])
+
 '''
 # Visualize the output for 3 random test samples
+# The predictor resizes the image to cfg.INPUT.MIN_SIZE_TEST, so it runs on the image decoded at 1/2 by read_image
+# whenever the short side stays at least that large, and the predictions are drawn on the reduced image.
 '''
+def get_preview_scale(d, max_scale=2):
+  return max([s for s in REDUCED_FLAGS
+              if s == 1 or (s <= max_scale and min(d['height'], d['width']) // s >= cfg.INPUT.MIN_SIZE_TEST)])
+
 
 print(data_train[0])
 print(data_test[0])
 
 for i in random.sample(data_test, 3):
-  image = cv2.imread(i['file_name'])
+  scale = get_preview_scale(i)
+  image = read_image(i['file_name'], scale)
   output = predictor(image)
 
   v = Visualizer(image[:, :, ::-1],
                  metadata = plane_test_metadata,
-                 scale = 0.5)
+                 scale = 0.5 * scale)
   out = v.draw_instance_predictions(output['instances'].to('cpu'))
   cv2_imshow(out.get_image()[:, :, ::-1])
 
@@ -260,20 +606,50 @@ print(inference_on_dataset(trainer.model, val_loader, evaluator))
 '''
 
 
-def get_instance_sample(data, idx, image):
+import pycocotools.mask as mask_util
+
+'''
+# Rasterizing the annotations of an image in bbox-local coordinates instead of allocating a full height*width
+# GenericMask for every annotation. The polygons are shifted into their bbox and rasterized with pycocotools
+# (the same way GenericMask does it), and the masks of an image are cached by file name so that training,
+# evaluation and submission writing rasterize each image only once.
+'''
 
-  annotations = data['annotations'][idx]
-  bbox = annotations['bbox']
-  x,y,w,h = bbox
-  x = int(x)
-  y = int(y)
-  w = int(w)
-  h = int(h)     
-  img = image[y:y+h, x:x+w]
+instance_mask_cache = {}
+
+def get_instance_masks(data):
+  if data['file_name'] in instance_mask_cache:
+    return instance_mask_cache[data['file_name']]
+
+  masks = []
+  for annotation in data['annotations']:
+    x, y, w, h = [int(v) for v in annotation['bbox']]
+    x1, y1 = min(x + w, data['width']), min(y + h, data['height'])
+    x, y = max(x, 0), max(y, 0)
+    w, h = max(x1 - x, 0), max(y1 - y, 0)
+    segmentation = annotation['segmentation']
+    if w == 0 or h == 0:
+      mask = np.zeros((h, w), dtype=np.uint8)
+    elif isinstance(segmentation, list):
+      polygons = [(np.asarray(p, dtype=np.float64).reshape(-1, 2) - [x, y]).reshape(-1)
+                  for p in segmentation if len(p) >= 6]
+      if len(polygons) == 0:
+        mask = np.zeros((h, w), dtype=np.uint8)
+      else:
+        mask = mask_util.decode(mask_util.merge(mask_util.frPyObjects(polygons, h, w)))
+    else:
+      mask = detectron2.utils.visualizer.GenericMask(segmentation, data['height'], data['width']).mask[y:y+h, x:x+w]
+    masks.append((x, y, w, h, mask))
+
+  instance_mask_cache[data['file_name']] = masks
+  return masks
+
+def get_instance_sample(data, idx, image=None):
+
+  x, y, w, h, mask = get_instance_masks(data)[idx]
+  # without the whole image only the box is decoded
+  img = image[y:y+h, x:x+w] if image is not None else read_image_region(data['file_name'], x, y, w, h)
     
-  mask = detectron2.utils.visualizer.GenericMask(data['annotations'][idx]['segmentation'], 
-                                                    data['height'], data['width']).mask
-  mask = mask[y:y+h, x:x+w]
   obj_img = cv2.resize(img, (128,128), interpolation = cv2.INTER_AREA) 
   obj_mask = cv2.resize(mask, (128,128), interpolation = cv2.INTER_AREA)
       
@@ -284,28 +660,94 @@ def get_instance_sample(data, idx, image):
 # A data loader for segmentation training
 #  __getitem__() 
 # Also added data augmentation or normalization in here
+# lazy = True only keeps an index of (image, annotation) pairs and makes the crops on demand in __getitem__, the
+# loader of get_plane_dataset then visits the instances image by image (ImageGroupSampler)
+# cache_file = path writes all the crops once into <path>_images.npy and <path>_masks.npy, which are then
+# memory-mapped read-only, so the DataLoader workers and the later runs share them without copying.
+# <path>_key.pkl stores the size and mtime of the images and of train.json (like the detection data cache), in the
+# order of data_list, and the crops are written again when any of them has changed.
 '''
 
 class PlaneDataset(Dataset):
-  def __init__(self, set_name, data_list):
+  def __init__(self, set_name, data_list, lazy=False, cache_file=None):
       self.transforms = transforms.Compose([
           transforms.ToTensor(), # Converting the image to tensor and change the image format (Channels-Last => Channels-First)
       ])
       self.set_name = set_name
       self.data = data_list
-      self.instance_map = []
-      for i, d in enumerate(tqdm(self.data)):
-        image = cv2.imread(d['file_name'])
-        for j in range(len(d['annotations'])):
-          img, mask = get_instance_sample(d, j, image)
-          self.instance_map.append((img, mask)) 
+      self.index = [(i, j) for i, d in enumerate(self.data) for j in range(len(d['annotations']))]
+      self.cache_file = cache_file
+      self.instance_map = None
+      self.images = None
+      self.masks = None
+
+      if cache_file is not None:
+        if not self.cache_is_valid():
+          self.write_cache()
+      elif not lazy:
+        self.instance_map = []
+        for i, d in enumerate(tqdm(self.data)):
+          image = image_cache.read(d['file_name'])
+          for j in range(len(d['annotations'])):
+            img, mask = get_instance_sample(d, j, image)
+            self.instance_map.append((img, mask)) 
+
+  def cache_paths(self):
+    return '{}_images.npy'.format(self.cache_file), '{}_masks.npy'.format(self.cache_file)
+
+  def cache_key(self):
+    filenames = [d['file_name'] for d in self.data]
+    if self.set_name != 'test':
+      filenames.append('{}/data/train.json'.format(BASE_DIR))
+    return list(get_file_stats(filenames).items())
+
+  def cache_is_valid(self):
+    image_path, mask_path = self.cache_paths()
+    key_path = '{}_key.pkl'.format(self.cache_file)
+    if not (os.path.exists(image_path) and os.path.exists(mask_path) and os.path.exists(key_path)):
+      return False
+    with open(key_path, 'rb') as f:
+      if pickle.load(f) != self.cache_key():
+        return False
+    images = np.load(image_path, mmap_mode='r')
+    masks = np.load(mask_path, mmap_mode='r')
+    return len(images) == len(self.index) and len(masks) == len(self.index)
+
+  def write_cache(self):
+    image_path, mask_path = self.cache_paths()
+    images = np.lib.format.open_memmap(image_path + '.tmp', mode='w+', dtype=np.uint8,
+                                       shape=(len(self.index), 128, 128, 3))
+    masks = np.lib.format.open_memmap(mask_path + '.tmp', mode='w+', dtype=np.uint8,
+                                      shape=(len(self.index), 128, 128))
+    for k, (i, j) in enumerate(tqdm(self.index)):
+      images[k], masks[k] = get_instance_sample(self.data[i], j, self.load_image(i))
+    images.flush()
+    masks.flush()
+    del images, masks
+    os.replace(image_path + '.tmp', image_path)
+    os.replace(mask_path + '.tmp', mask_path)
+    key_path = '{}_key.pkl'.format(self.cache_file)
+    with open(key_path + '.tmp', 'wb') as f:
+      pickle.dump(self.cache_key(), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(key_path + '.tmp', key_path)
+
+  def load_image(self, i):
+    # the crops of the same image and the later stages share the decoded image
+    return image_cache.read(self.data[i]['file_name'])
+
+  def __getstate__(self):
+    # the memory maps are reopened in every DataLoader worker instead of being pickled
+    state = self.__dict__.copy()
+    state['images'] = None
+    state['masks'] = None
+    return state
 
   '''
   # you can change the value of length to a small number like 10 for debugging of your training procedure and overfeating
   # make sure to use the correct length for the final training
   '''
   def __len__(self):
-      return len(self.instance_map)
+      return len(self.index)
 
   def numpy_to_tensor(self, img, mask):
     if self.transforms is not None:
@@ -324,13 +766,57 @@ class PlaneDataset(Dataset):
     if torch.is_tensor(idx):
         idx = idx.tolist()        
 
-    return self.instance_map[idx]
+    if self.cache_file is not None:
+      if self.images is None:
+        image_path, mask_path = self.cache_paths()
+        self.images = np.load(image_path, mmap_mode='r')
+        self.masks = np.load(mask_path, mmap_mode='r')
+      return np.array(self.images[idx]), np.array(self.masks[idx])
+
+    if self.instance_map is not None:
+      return self.instance_map[idx]
+
+    # ImageGroupSampler keeps the instances of an image together, so a worker decodes the image once and
+    # crops the following instances from its image_cache
+    i, j = self.index[idx]
+    return get_instance_sample(self.data[i], j, self.load_image(i))
+
+'''
+# Shuffles the images and the instances within every image, but keeps the instances of an image next to each other.
+# The DataLoader workers take turns on the batches, so an image with many planes is decoded by at most one worker per
+# batch it spans instead of once per plane, and each worker only needs a small image_cache (WORKER_CACHE_BYTES).
+'''
+WORKER_CACHE_BYTES = 2**28
+
+class ImageGroupSampler(torch.utils.data.Sampler):
+  def __init__(self, index):
+    self.index = index
 
-def get_plane_dataset(set_name='train', batch_size=2):
+  def __len__(self):
+    return len(self.index)
+
+  def __iter__(self):
+    groups = {}
+    for idx, (i, _) in enumerate(self.index):
+      groups.setdefault(i, []).append(idx)
+    groups = list(groups.values())
+    order = []
+    for g in torch.randperm(len(groups)).tolist():
+      order.extend(groups[g][k] for k in torch.randperm(len(groups[g])).tolist())
+    return iter(order)
+
+def shrink_image_cache(worker_id):
+  # every worker has its own copy of image_cache, it only has to hold the images of the current batches
+  image_cache.max_bytes = WORKER_CACHE_BYTES
+  image_cache.clear()
+
+def get_plane_dataset(set_name='train', batch_size=2, lazy=False, cache_file=None):
     my_data_list = DatasetCatalog.get("airplane_{}".format(set_name))
-    dataset = PlaneDataset(set_name, my_data_list)
-    loader = DataLoader(dataset, batch_size=batch_size, num_workers=4,
-                                              pin_memory=True, shuffle=True)
+    dataset = PlaneDataset(set_name, my_data_list, lazy, cache_file)
+    grouped = lazy and cache_file is None
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=4, pin_memory=True, shuffle=not grouped,
+                        sampler=ImageGroupSampler(dataset.index) if grouped else None,
+                        worker_init_fn=shrink_image_cache)
     return loader, dataset
 
 """### Network"""
@@ -408,10 +894,6 @@ class MyModel(nn.Module):
         self.up2 = up(64, 32)
         self.up3 = up(32, 3)
         self.output_conv = conv(3, 1, False) 
-        
-        self.normal1 = nn.BatchNorm2d(32)
-        self.normal2 = nn.BatchNorm2d(64)
-        self.normal3 = nn.BatchNorm2d(128)
 
     def forward(self, input):
       y = self.input_conv(input)
@@ -424,10 +906,167 @@ class MyModel(nn.Module):
       output = self.output_conv(y)
       return output
 
+    def load_state_dict(self, state_dict, *args, **kwargs):
+      # the checkpoints saved before the unused normal1..3 layers were removed still contain their weights
+      state_dict = {k: v for k, v in state_dict.items() if not k.startswith('normal')}
+      return super(MyModel, self).load_state_dict(state_dict, *args, **kwargs)
+
 from torchsummary import summary
 
-model = MyModel().cuda()
-summary(model, (3, 128, 128))
+model = MyModel().to(DEVICE, memory_format=MEMORY_FORMAT)
+summary(model, (3, 128, 128), device=DEVICE.type)
+
+"""### Inference export"""
+
+'''
+# At inference the BatchNorm layers only scale and shift the output of the conv (or linear) layer in front of them,
+# so they are folded into its weights and bias, and the modules that are not used in forward are dropped.
+# export_model saves the folded model as a frozen TorchScript file (and as ONNX when onnx_path is given),
+# load_exported_model loads it back for the evaluation and the Part 3 prediction code.
+'''
+from torch.fx.experimental.optimization import fuse as fuse_conv_bn
+
+def export_model(model, path, size=128, onnx_path=None):
+  fused = fuse_conv_bn(model.eval())
+  example = torch.zeros(1, 3, size, size, device=DEVICE).contiguous(memory_format=MEMORY_FORMAT)
+  with torch.no_grad():
+    exported = torch.jit.freeze(torch.jit.trace(fused, example))
+  exported.save(path)
+  if onnx_path is not None:
+    torch.onnx.export(fused, example, onnx_path, input_names=['image'], output_names=['logits'],
+                      dynamic_axes={'image': {0: 'batch'}, 'logits': {0: 'batch'}})
+  return exported
+
+def load_exported_model(path):
+  return torch.jit.load(path, map_location=DEVICE)
+
+'''
+# latency of the eager and the exported model per batch, the outputs are compared on the first batch size
+'''
+def benchmark_export(model, exported, batch_sizes=(1, 4, 16, 64, 256), size=128, repeats=10):
+  model.eval()
+  for batch_size in batch_sizes:
+    images = torch.randn(batch_size, 3, size, size, device=DEVICE).contiguous(memory_format=MEMORY_FORMAT)
+    times = []
+    with torch.inference_mode():
+      for net in (model, exported):
+        net(images) # warm-up
+        if DEVICE.type == 'cuda':
+          torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+          net(images)
+        if DEVICE.type == 'cuda':
+          torch.cuda.synchronize()
+        times.append((time.perf_counter() - start) / repeats)
+      if batch_size == batch_sizes[0]:
+        print("max difference: {:.2e}".format((model(images) - exported(images)).abs().max().item()))
+    print("batch {:4d}: eager {:8.2f} ms, exported {:8.2f} ms, speedup {:.2f}x".format(
+        batch_size, times[0] * 1000, times[1] * 1000, times[0] / times[1]))
+
+"""### Checkpoints"""
+
+'''
+# CheckpointManager snapshots the model, optimizer, scheduler and RNG states after every epoch and writes them
+# in a background thread, so the training only waits for the copy of the tensors to the CPU.
+# It keeps the last keep_last checkpoints and the keep_best ones with the best metric (mode = 'min' or 'max'),
+# the others are deleted. Every file is written to a temporary name and renamed, and <prefix>s.json lists the
+# complete ones, so a node which is preempted in the middle of a write resumes from the previous checkpoint.
+# resume() restores the latest checkpoint and returns the epoch to continue from, with the same RNG states the
+# shuffling and augmentation of the following epochs are the ones of an uninterrupted run.
+'''
+def to_cpu(state):
+  if torch.is_tensor(state):
+    return state.detach().to('cpu', copy=True)
+  if isinstance(state, dict):
+    return {k: to_cpu(v) for k, v in state.items()}
+  if isinstance(state, (list, tuple)):
+    return type(state)(to_cpu(v) for v in state)
+  return copy.deepcopy(state)
+
+def get_rng_state():
+  return {'torch': torch.get_rng_state(), 'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+          'numpy': np.random.get_state(), 'random': random.getstate()}
+
+def set_rng_state(state):
+  torch.set_rng_state(state['torch'])
+  if state['cuda'] and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state['cuda'])
+  np.random.set_state(state['numpy'])
+  random.setstate(state['random'])
+
+class CheckpointManager:
+  def __init__(self, directory, prefix='checkpoint', keep_last=2, keep_best=1, mode='max'):
+    self.directory = directory
+    self.prefix = prefix
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.mode = mode
+    self.index_path = os.path.join(directory, '{}s.json'.format(prefix))
+    self.checkpoints = []
+    if os.path.exists(self.index_path):
+      with open(self.index_path) as f:
+        self.checkpoints = json.load(f)
+    os.makedirs(directory, exist_ok=True)
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.pending = None
+
+  def save(self, epoch, model, optimizer, scheduler=None, metric=None, **extra):
+    state = {'epoch': epoch, 'metric': metric, 'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+             'scheduler': scheduler.state_dict() if scheduler is not None else None,
+             'rng': get_rng_state(), 'extra': extra}
+    state = to_cpu(state)
+    self.wait() # one write at a time, an error of the previous write is raised here
+    self.pending = self.executor.submit(self.write, state)
+
+  def write(self, state):
+    path = os.path.join(self.directory, '{}_{:04d}.pth'.format(self.prefix, state['epoch']))
+    torch.save(state, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    checkpoints = self.checkpoints + [{'epoch': state['epoch'], 'metric': state['metric'], 'path': path}]
+
+    keep = sorted(checkpoints, key=lambda c: c['epoch'])[-self.keep_last:] if self.keep_last > 0 else []
+    rated = [c for c in checkpoints if c['metric'] is not None]
+    rated.sort(key=lambda c: c['metric'], reverse=self.mode == 'max')
+    keep += rated[:self.keep_best]
+    self.checkpoints = [c for c in checkpoints if c in keep]
+
+    with open(self.index_path + '.tmp', 'w') as f:
+      json.dump(self.checkpoints, f)
+    os.replace(self.index_path + '.tmp', self.index_path)
+    for c in checkpoints:
+      if c not in keep and os.path.exists(c['path']):
+        os.remove(c['path'])
+
+  def wait(self):
+    if self.pending is not None:
+      self.pending.result()
+      self.pending = None
+
+  def best(self):
+    self.wait()
+    rated = [c for c in self.checkpoints if c['metric'] is not None]
+    if not rated:
+      return None
+    return (max if self.mode == 'max' else min)(rated, key=lambda c: c['metric'])['path']
+
+  def resume(self, model, optimizer, scheduler=None):
+    self.wait()
+    if not self.checkpoints:
+      return 0, {}
+    latest = max(self.checkpoints, key=lambda c: c['epoch'])
+    state = torch.load(latest['path'], map_location='cpu', weights_only=False)
+    model.load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    if scheduler is not None and state['scheduler'] is not None:
+      scheduler.load_state_dict(state['scheduler'])
+    set_rng_state(state['rng'])
+    print("Resuming from {}, continuing at epoch {}".format(latest['path'], state['epoch'] + 1))
+    return state['epoch'] + 1, state['extra']
+
+  def close(self):
+    self.wait()
+    self.executor.shutdown()
 
 """### Training"""
 
@@ -443,40 +1082,47 @@ learning_rate = 0.001
 weight_decay = 1e-5
 
 model = MyModel() # initialize the model
-model = model.cuda() # move the model to GPU
+model = model.to(DEVICE, memory_format=MEMORY_FORMAT) # move the model to the device
 loader, _ = get_plane_dataset('train', batch_size) # initialize data_loader
 crit = nn.BCEWithLogitsLoss() # Define the loss function
 optim = torch.optim.SGD(model.parameters(), lr=learning_rate, weight_decay=weight_decay) # Initialize the optimizer as SGD
 
+# there is no validation set for the crops, the best checkpoint is the one with the lowest training loss
+checkpoints = CheckpointManager('{}/output/checkpoints'.format(BASE_DIR), 'segmentation', keep_last=2, keep_best=1, mode='min')
+start_epoch, _ = checkpoints.resume(model, optim)
+
 # start the training procedure
-for epoch in range(num_epochs):
+for epoch in range(start_epoch, num_epochs):
   total_loss = 0
   for (img, mask) in tqdm(loader):
     
     
-    cv2_imshow(img[0].cpu().detach().permute((0,1,2)).numpy())
-    img = torch.tensor(img, dtype=torch.float, device=torch.device('cuda'), requires_grad = True)
+    if DEBUG_VIS:
+      cv2_imshow(img[0].cpu().detach().permute((0,1,2)).numpy())
+    img = torch.tensor(img, dtype=torch.float, device=DEVICE, requires_grad = True)
     img = torch.permute(img, (0,3,1,2))
-    mask = torch.tensor(mask, dtype=torch.float, device=torch.device('cuda'), requires_grad = True).unsqueeze(1)
+    mask = torch.tensor(mask, dtype=torch.float, device=DEVICE, requires_grad = True).unsqueeze(1)
     
-    cv2_imshow((mask[0]*255).cpu().detach().permute(1,2,0).numpy())
-    pred = model(img)
-    cv2_imshow((pred[0]*255).cpu().detach().permute(1,2,0).numpy())
-    loss = crit(pred, mask)
-    optim.zero_grad()
-    loss.backward()
-    optim.step()
+    if DEBUG_VIS:
+      cv2_imshow((mask[0]*255).cpu().detach().permute(1,2,0).numpy())
+    with profiler.timer('train_step'):
+      pred = model(img)
+      if DEBUG_VIS:
+        cv2_imshow((pred[0]*255).cpu().detach().permute(1,2,0).numpy())
+      loss = crit(pred, mask)
+      optim.zero_grad()
+      loss.backward()
+      optim.step()
     total_loss += loss.cpu().data
   print("Epoch: {}, Loss: {}".format(epoch, total_loss/len(loader)))
-  torch.save(model.state_dict(), '{}/output/{}_segmentation_model.pth'.format(BASE_DIR, epoch))
+  checkpoints.save(epoch, model, optim, metric=float(total_loss/len(loader)))
+checkpoints.close()
 
 '''
 # Saving the final model
 '''
 torch.save(model.state_dict(), '{}/output/final_segmentation_model.pth'.format(BASE_DIR))
 
-torch.save(model.state_dict(), '{}/output/final_segmentation_model.pth'.format(BASE_DIR))
-
 """### Evaluation and Visualization"""
 
 '''
@@ -484,51 +1130,148 @@ torch.save(model.state_dict(), '{}/output/final_segmentation_model.pth'.format(B
 # We may load the trained model again, in case if we want to continue our code later
 '''
 batch_size = 4
-model = MyModel().cuda()
-model.load_state_dict(torch.load('{}/output/final_segmentation_model.pth'.format(BASE_DIR)))
+model = MyModel().to(DEVICE, memory_format=MEMORY_FORMAT)
+model.load_state_dict(torch.load('{}/output/final_segmentation_model.pth'.format(BASE_DIR), map_location=DEVICE))
 model = model.eval() # chaning the model to evaluation mode will fix the bachnorm layers
+
+# the evaluation and Part 3 use the exported model with the batchnorm layers folded into the convolutions
+exported = export_model(model, '{}/output/final_segmentation_model.ts'.format(BASE_DIR))
+if RUN_BENCHMARKS:
+  benchmark_export(model, exported)
+model = load_exported_model('{}/output/final_segmentation_model.ts'.format(BASE_DIR))
 loader, dataset = get_plane_dataset('train', batch_size)
 
-def sigmoid(x):
-  return 1/(1 + np.exp(-x))
+'''
+# Batched evaluation of the crop segmentation: every batch is compared with its masks on the device, for all the
+# thresholds (on the sigmoid probability) at once, so a sweep needs a single pass over the data.
+# The probabilities are bucketized by the thresholds and the foreground / background pixels are counted per bucket,
+# the reversed cumulative sums then give the true positives and false positives of every crop at every threshold.
+# At the threshold 0.5 the IoU of a crop is the one of the previous per-sample iou_coef (mask > 0 against
+# sigmoid(logit) > 0.5, 0 if both are empty).
+# The predictions are resized to the mask size if the network output is larger than its input.
+'''
+class SegmentationEvaluator:
+  def __init__(self, thresholds=(0.5,), device=DEVICE):
+    self.device = device
+    self.thresholds = torch.tensor(sorted(thresholds), dtype=torch.float, device=device)
+    self.tp, self.fp, self.fn = [], [], []
+
+  def update(self, logits, masks):
+    masks = masks.to(self.device)
+    logits = logits.to(self.device).float()
+    if logits.dim() == 4:
+      logits = logits[:, 0]
+    if logits.shape[-2:] != masks.shape[-2:]:
+      logits = F.interpolate(logits[:, None], size=masks.shape[-2:], mode='bilinear', align_corners=False)[:, 0]
+
+    n, t = len(logits), len(self.thresholds)
+    truth = (masks > 0).flatten(1)
+    # bucket b holds the pixels above the thresholds 0..b-1
+    buckets = torch.bucketize(torch.sigmoid(logits).flatten(1), self.thresholds)
+    keys = (torch.arange(n, device=self.device)[:, None] * (t + 1) + buckets) * 2 + truth
+    counts = torch.bincount(keys.flatten(), minlength=n * (t + 1) * 2).view(n, t + 1, 2)
+    above = counts.flip(1).cumsum(1).flip(1)[:, 1:]
+    tp = above[..., 1]
+    self.tp.append(tp)
+    self.fp.append(above[..., 0])
+    self.fn.append(truth.sum(1, keepdim=True) - tp)
 
-def iou_coef(y_true, y_pred):
-  y_true = np.rint(sigmoid(y_true))
-  y_pred = np.rint(sigmoid(y_pred))
-  intersection = np.count_nonzero(np.multiply(y_true, y_pred))
-  union = np.count_nonzero(y_true+y_pred)
-  if union == 0:
-      return 0
-  return intersection/union
+  '''
+  # returns one row per threshold with the mean IoU and Dice over the crops, the pixel precision and recall,
+  # and the quantiles of the per-crop IoU
+  '''
+  def summary(self, quantiles=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    tp, fp, fn = (torch.cat(x).double() for x in (self.tp, self.fp, self.fn))
+    iou = torch.where(tp + fp + fn > 0, tp / (tp + fp + fn), torch.zeros_like(tp))
+    dice = torch.where(tp + fp + fn > 0, 2 * tp / (2 * tp + fp + fn), torch.zeros_like(tp))
+    precision = tp.sum(0) / (tp + fp).sum(0).clamp(min=1)
+    recall = tp.sum(0) / (tp + fn).sum(0).clamp(min=1)
+    iou_quantiles = torch.quantile(iou, torch.tensor(quantiles, dtype=iou.dtype, device=iou.device), dim=0)
+    rows = []
+    for j, threshold in enumerate(self.thresholds.tolist()):
+      rows.append({'threshold': threshold, 'count': len(iou), 'mean_iou': iou[:, j].mean().item(),
+                   'mean_dice': dice[:, j].mean().item(), 'precision': precision[j].item(),
+                   'recall': recall[j].item(),
+                   'iou_quantiles': dict(zip(quantiles, iou_quantiles[:, j].tolist()))})
+    return rows
+
+def evaluate_segmentation(model, loader, thresholds=(0.5,), device=DEVICE):
+  evaluator = SegmentationEvaluator(thresholds, device)
+  with torch.inference_mode():
+    for (img, mask) in tqdm(loader):
+      img = torch.permute(img.to(device).float(), (0,3,1,2))
+      evaluator.update(model(img), mask)
+  return evaluator.summary()
+
+def get_mean_iou(model, loader, device=DEVICE):
+  result = evaluate_segmentation(model, loader, (0.5,), device)[0]
+  return result['count'], result['mean_iou']
+
+count, mean_iou = get_mean_iou(model, loader)
+print("\n #images: {}, Mean IoU: {}".format(count, mean_iou))
 
+'''
+# Threshold sweep from a single pass over the data
+'''
+for row in evaluate_segmentation(model, loader, thresholds=np.linspace(0.1, 0.9, 9)):
+  print("threshold {:.2f}: Mean IoU {:.4f}, Mean Dice {:.4f}, precision {:.4f}, recall {:.4f}, IoU quantiles {}".format(
+      row['threshold'], row['mean_iou'], row['mean_dice'], row['precision'], row['recall'],
+      ', '.join('{:.0%}: {:.3f}'.format(q, v) for q, v in row['iou_quantiles'].items())))
 
-total_iou = 0
-count = 0
-for (img, mask) in tqdm(loader):
+"""### Int8 quantization"""
+
+'''
+# Post-training static quantization for the CPU nodes: the conv + batchnorm + relu blocks, the transposed convolutions
+# and the output conv run in int8, with the activation ranges calibrated on num_batches batches of PlaneDataset crops.
+# The quantized model is saved as a frozen TorchScript file which load_exported_model loads like the float one.
+# Quantized kernels only exist for the CPU, so the float model is reloaded on the CPU from its checkpoint.
+'''
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+def quantize_model(model, loader, path, num_batches=32):
+  model = model.cpu().eval()
+  calibration = []
+  for (img, mask) in loader:
+    calibration.append(torch.permute(img.float(), (0,3,1,2)).contiguous(memory_format=torch.channels_last))
+    if len(calibration) == num_batches:
+      break
+
+  prepared = prepare_fx(model, get_default_qconfig_mapping('x86'), (calibration[0],))
   with torch.no_grad():
-    img = img.float()
-    img = torch.permute(img, (0,3,1,2))
-    img = img.cuda()
-
-    mask = torch.tensor(mask, dtype=torch.float, device=torch.device('cuda'), requires_grad = True)
-
-   # cv2_imshow((mask*255).cpu().detach().permute(1,2,0).numpy())
-    pred = model(img).cpu().detach()
-   # cv2_imshow((pred[0]*255).cpu().detach().permute(1,2,0).numpy())
-    for i in range(img.shape[0]):
-        newimg = transforms.ToPILImage()(img[i].cpu())
-        predicted = np.array(pred[i])[0]
-        #cv2_imshow(np.array(newimg))
-        #print(pred[i])
-        masked = np.array(mask[i].cpu().detach())
-        count+=1
-        total_iou+=iou_coef(masked, predicted)
-  '''
-  ## Obtaining the IoU for each img and print the final Mean IoU
-  '''
-    
+    for img in calibration:
+      prepared(img)
+    quantized = torch.jit.freeze(torch.jit.trace(convert_fx(prepared), calibration[0]))
+  quantized.save(path)
+  return quantized
+
+def get_throughput(model, size=128, batch_size=64, repeats=10):
+  images = torch.rand(batch_size, 3, size, size).mul(255).contiguous(memory_format=torch.channels_last)
+  with torch.inference_mode():
+    model(images) # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+      model(images)
+  return batch_size * repeats / (time.perf_counter() - start)
+
+float_path = '{}/output/final_segmentation_model.pth'.format(BASE_DIR)
+int8_path = '{}/output/final_segmentation_model_int8.ts'.format(BASE_DIR)
+float_model = MyModel()
+float_model.load_state_dict(torch.load(float_path, map_location='cpu'))
+int8_model = quantize_model(float_model, loader, int8_path)
+
+_, float_iou = get_mean_iou(float_model, loader, torch.device('cpu'))
+_, int8_iou = get_mean_iou(int8_model, loader, torch.device('cpu'))
+print("Mean IoU: float {:.4f}, int8 {:.4f} ({:+.4f})".format(float_iou, int8_iou, int8_iou - float_iou))
+print("size: float {:.2f} MB, int8 {:.2f} MB".format(os.path.getsize(float_path) / 2**20, os.path.getsize(int8_path) / 2**20))
+print("CPU throughput: float {:.1f} crops/s, int8 {:.1f} crops/s".format(get_throughput(float_model), get_throughput(int8_model)))
 
-print("\n #images: {}, Mean IoU: {}".format(count, total_iou/count))
+'''
+# set USE_INT8 on the CPU nodes to run the Part 3 predictions with the int8 model
+'''
+USE_INT8 = False
+if USE_INT8 and DEVICE.type == 'cpu':
+  model = load_exported_model(int8_path)
 
 """## Part 3: Instance Segmentation
 
@@ -544,85 +1287,979 @@ In this part, you need to obtain the instance segmentation results for the test
 # pred_mask is the instance segmentation result and should have different values for different airplanes.
 '''
 
+from detectron2.structures import Boxes, Instances
+
+'''
+# Tiled inference for full-resolution scenes
+# Large map mosaics are cut into overlapping tile_size*tile_size tiles which are passed through the detector in
+# batches of batch_size, so the detector memory only depends on the tile size and not on the scene size.
+# The boxes are shifted back to scene coordinates and the duplicates on the tile seams are merged: a box which
+# touches a tile edge inside the scene is probably cut off, so the complete boxes are kept first, and a box on a
+# seam is also dropped when more than nms_thresh of the smaller of the two boxes is covered (a plane which is 30%
+# visible in one tile only has an IoU of about 0.3 with its complete box in the next tile).
+# overlap should be at least as large as the biggest airplane so that every plane is complete in some tile.
+# With a tile_filter (see Tile pre-filter) only the tiles it accepts are passed to the detector.
+# TiledPredictor is a BatchPredictor which does this for the scenes larger than TILE_SIZE, it is used by
+# get_prediction_masks, the result cache and the submission pipeline. TILE_SIZE = None (the default) runs the
+# detector on the whole scenes as in Part 1, with TILE_SIZE = 1024 the tiled scenes are read tile row by tile row
+# with a SceneReader instead of being decoded whole, and the boxes of the large scenes can differ from Part 1.
+# With merge = False TiledPredictor returns the boxes of all the tiles with their on_seam flags, get_kept_boxes
+# thresholds and merges them later (see Result cache).
+'''
+TILE_SIZE = None
+TILE_OVERLAP = 128
+
+def get_tile_origins(height, width, tile_size=1024, overlap=128):
+  stride = tile_size - overlap
+  assert stride > 0, "overlap must be smaller than tile_size"
+
+  def starts(length):
+    origins = list(range(0, max(length - tile_size, 0) + 1, stride))
+    if origins[-1] + tile_size < length:
+      origins.append(length - tile_size)
+    return origins
+
+  return [(x, y) for y in starts(height) for x in starts(width)]
+
+def on_tile_seam(boxes, x, y, tile_w, tile_h, width, height, margin=2):
+  # only the tile edges inside the scene cut the boxes
+  return (((boxes[:, 0] <= margin) & (x > 0)) | ((boxes[:, 1] <= margin) & (y > 0)) |
+          ((boxes[:, 2] >= tile_w - margin) & (x + tile_w < width)) |
+          ((boxes[:, 3] >= tile_h - margin) & (y + tile_h < height)))
+
+def merge_tile_boxes(boxes, scores, on_seam, nms_thresh=0.5):
+  # the scores are in [0, 1], so all the complete boxes come before the boxes on a seam
+  order = torch.argsort(scores - 2 * on_seam.float(), descending=True)
+  boxes, on_seam = boxes[order], on_seam[order]
+  areas = (boxes[:, 2:] - boxes[:, :2]).clamp(min=0).prod(1)
+  removed = torch.zeros(len(boxes), dtype=torch.bool)
+  keep = []
+  for i in range(len(boxes)):
+    if removed[i]:
+      continue
+    keep.append(i)
+    # one row of the overlaps at a time, a scene can have thousands of boxes
+    size = (torch.min(boxes[i, 2:], boxes[:, 2:]) - torch.max(boxes[i, :2], boxes[:, :2])).clamp(min=0)
+    intersection = size.prod(1)
+    iou = intersection / (areas[i] + areas - intersection).clamp(min=1e-6)
+    covered = intersection / torch.min(areas[i], areas).clamp(min=1e-6)
+    removed |= (iou > nms_thresh) | ((covered > nms_thresh) & (on_seam[i] | on_seam))
+  return order[torch.tensor(keep, dtype=torch.long)]
+
+def get_kept_boxes(scores, score_thresh, boxes=None, on_seam=None, nms_thresh=0.5):
+  # the indices of the boxes above score_thresh, for the unmerged boxes of a tiled scene in the order of the merge
+  index = torch.nonzero(scores > score_thresh).flatten()
+  if on_seam is not None:
+    index = index[merge_tile_boxes(boxes[index], scores[index], on_seam[index], nms_thresh)]
+  return index
+
+def get_tiled_predictions(image, tile_size=1024, overlap=128, batch_size=4, nms_thresh=0.5, tile_filter=None,
+                          batch_predictor=None, merge=True):
+  batch_predictor = batch_predictor if batch_predictor is not None else BatchPredictor(predictor, batch_size)
+  height, width = image.shape[:2]
+  # the origins go row by row, so a SceneReader reads every band once
+  origins = get_tile_origins(height, width, tile_size, overlap)
+  boxes = [torch.zeros((0, 4))]
+  scores = [torch.zeros(0)]
+  on_seam = [torch.zeros(0, dtype=torch.bool)]
+  for k in range(0, len(origins), batch_size):
+    batch = origins[k:k+batch_size]
+    tiles = [image[y:y+tile_size, x:x+tile_size] for x, y in batch]
+    if tile_filter is not None:
+      keep = tile_filter(tiles)
+      batch = [origin for origin, keep_k in zip(batch, keep) if keep_k]
+      tiles = [tile for tile, keep_k in zip(tiles, keep) if keep_k]
+      if not tiles:
+        continue
+    for (x, y), tile, output in zip(batch, tiles, batch_predictor(tiles)):
+      instances = output['instances'].to('cpu')
+      tile_boxes = instances.pred_boxes.tensor
+      on_seam.append(on_tile_seam(tile_boxes, x, y, tile.shape[1], tile.shape[0], width, height))
+      boxes.append(tile_boxes + torch.tensor([x, y, x, y], dtype=tile_boxes.dtype))
+      scores.append(instances.scores)
+
+  boxes = torch.cat(boxes)
+  scores = torch.cat(scores)
+  if not merge:
+    return boxes, scores, torch.cat(on_seam)
+  keep = merge_tile_boxes(boxes, scores, torch.cat(on_seam), nms_thresh)
+  return boxes[keep], scores[keep]
+
+class TiledPredictor(BatchPredictor):
+  def __init__(self, predictor, batch_size=4, num_workers=4, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    super(TiledPredictor, self).__init__(predictor, batch_size, num_workers)
+    self.tile_size = tile_size
+    self.overlap = overlap
+    self.merge = True
+
+  def tiled(self, image):
+    return self.tile_size is not None and max(image.shape[:2]) > self.tile_size
+
+  def load(self, filename):
+    # the tiled scenes are read by bands in detect and segment_crops, only their header is read here
+    width, height = get_image_size(filename)
+    if self.tile_size is not None and max(height, width) > self.tile_size:
+      return SceneReader(filename, height, width, self.tile_size), None
+    return super(TiledPredictor, self).load(filename)
+
+  def prepare(self, image):
+    if self.tiled(image): # the tiles are preprocessed in detect
+      return image, None
+    return super(TiledPredictor, self).prepare(image)
+
+  def detect(self, images, inputs=None, tile_filter=None):
+    inputs = inputs if inputs is not None else [None] * len(images)
+    whole = [k for k, image in enumerate(images) if not self.tiled(image)]
+    outputs = [None] * len(images)
+    if whole:
+      detected = super(TiledPredictor, self).detect([images[k] for k in whole], [inputs[k] for k in whole], tile_filter)
+      for k, output in zip(whole, detected):
+        outputs[k] = output
+    for k, image in enumerate(images):
+      if self.tiled(image) and self.merge:
+        boxes, scores = get_tiled_predictions(image, self.tile_size, self.overlap, self.batch_size,
+                                              tile_filter=tile_filter, batch_predictor=self)
+        outputs[k] = {'instances': Instances(image.shape[:2], pred_boxes=Boxes(boxes), scores=scores)}
+      elif self.tiled(image):
+        boxes, scores, on_seam = get_tiled_predictions(image, self.tile_size, self.overlap, self.batch_size,
+                                                       tile_filter=tile_filter, batch_predictor=self, merge=False)
+        outputs[k] = {'instances': Instances(image.shape[:2], pred_boxes=Boxes(boxes), scores=scores,
+                                             on_seam=on_seam)}
+    return outputs
+
+'''
+# Sparse instance masks
+# A scene is stored as the boxes (x0, y0, x1, y1) of its K instances and one bbox-local boolean mask per instance.
+# The masks are ragged: data is one flat buffer with the (y1-y0)*(x1-x0) pixels of every instance in row-major
+# order, instance k (id k+1) starts at offsets[k]. This takes the summed box areas in bytes instead of height*width
+# values per label image (or K times the largest box when the masks are padded), and it stays on the device of data.
+# size_buckets groups the instances of similar box sizes, so the code which needs a padded (n, h, w) batch
+# (the paste, box_masks, from_full_masks) only pads within a bucket of at most max_pixels pixels.
+# resolve_overlaps() clears the pixels of the instances which are covered by a higher id, as in a label image.
+# coordinates() gives the instance and the row-major scene index of every foreground pixel (sorted by instance,
+# then by pixel), which is all that the RLE encoding and the IoU need. to_label_image() only builds the dense
+# uint16 label image when it is asked for, render() draws a downscaled label image for the visualization.
+# from_full_masks converts full-image masks (the pred_masks of Mask R-CNN) and box_masks(size) resizes every
+# instance mask to size*size, e.g. as the training target of a mask head. select(keep) keeps a subset.
+'''
+def size_buckets(sizes, max_pixels=2**22):
+  # sizes are the (w, h) of the boxes, every bucket pads to its largest box
+  order = torch.argsort(sizes.prod(1)).tolist()
+  sizes = sizes.tolist()
+  buckets, bucket, max_w, max_h = [], [], 0, 0
+  for k in order:
+    w, h = max(max_w, sizes[k][0]), max(max_h, sizes[k][1])
+    if bucket and (len(bucket) + 1) * w * h > max_pixels:
+      buckets.append(bucket)
+      bucket, w, h = [], sizes[k][0], sizes[k][1]
+    bucket.append(k)
+    max_w, max_h = w, h
+  if bucket:
+    buckets.append(bucket)
+  return buckets
+
+def concat_ranges(starts, lengths):
+  # starts[j], ..., starts[j] + lengths[j] - 1 for every j, one after the other
+  first = torch.cumsum(lengths, 0) - lengths
+  return (torch.arange(int(lengths.sum()), device=starts.device) - first.repeat_interleave(lengths)
+          + starts.repeat_interleave(lengths))
+
+class InstanceMasks:
+  def __init__(self, boxes, data, height, width):
+    self.boxes = boxes.long()
+    self.data = data.bool()
+    self.height = height
+    self.width = width
+    self.sizes = (self.boxes[:, 2:] - self.boxes[:, :2]).clamp(min=0)
+    areas = self.sizes.prod(1)
+    self.offsets = torch.cat((torch.zeros(1, dtype=torch.long, device=areas.device), torch.cumsum(areas, 0)))
+    assert len(self.data) == int(self.offsets[-1]), "data does not match the box sizes"
+
+  @staticmethod
+  def from_annotations(data, device=DEVICE):
+    instances = get_instance_masks(data)
+    boxes = np.array([(x, y, x + w, y + h) for x, y, w, h, _ in instances], dtype=np.int64).reshape(-1, 4)
+    flat = np.concatenate([mask.ravel() > 0 for _, _, _, _, mask in instances] + [np.zeros(0, dtype=bool)])
+    return InstanceMasks(torch.from_numpy(boxes).to(device), torch.from_numpy(flat).to(device),
+                         data['height'], data['width']).resolve_overlaps()
+
+  @staticmethod
+  def empty(height, width, device=DEVICE):
+    return InstanceMasks(torch.zeros((0, 4), dtype=torch.long, device=device),
+                         torch.zeros(0, dtype=torch.bool, device=device), height, width)
+
+  @staticmethod
+  def from_full_masks(masks):
+    masks = masks.bool()
+    count, height, width = masks.shape
+    rows = masks.any(2)
+    cols = masks.any(1)
+    # first and one past the last row / column of every mask, an empty mask gets an empty box
+    y0 = rows.int().argmax(1)
+    y1 = torch.where(rows.any(1), height - rows.flip(1).int().argmax(1), y0)
+    x0 = cols.int().argmax(1)
+    x1 = torch.where(cols.any(1), width - cols.flip(1).int().argmax(1), x0)
+    instances = InstanceMasks(torch.stack((x0, y0, x1, y1), dim=1),
+                              torch.zeros(int(((x1 - x0) * (y1 - y0)).sum()), dtype=torch.bool, device=masks.device),
+                              height, width)
+    for index in size_buckets(instances.sizes):
+      index = torch.tensor(index, device=masks.device)
+      _, _, valid = instances.bucket_grid(index)
+      ys = y0[index, None] + torch.arange(valid.shape[1], device=masks.device)
+      xs = x0[index, None] + torch.arange(valid.shape[2], device=masks.device)
+      local = masks[index[:, None, None], ys.clamp(max=height - 1)[:, :, None], xs.clamp(max=width - 1)[:, None, :]]
+      instances.data[instances.positions(index)] = local[valid]
+    return instances.resolve_overlaps()
+
+  def __len__(self):
+    return len(self.boxes)
+
+  @property
+  def device(self):
+    return self.data.device
+
+  def positions(self, index):
+    # the indices into data of the pixels of the instances in index, in the order of index
+    return concat_ranges(self.offsets[index], self.offsets[index + 1] - self.offsets[index])
+
+  def bucket_grid(self, index):
+    # the rows and columns of the padded (len(index), max_h, max_w) batch of the instances in index, and which of
+    # its pixels are inside their box (in the order of positions(index))
+    sizes = self.sizes[index]
+    max_w, max_h = int(sizes[:, 0].max()), int(sizes[:, 1].max())
+    cols = torch.arange(max_w, device=self.device)
+    rows = torch.arange(max_h, device=self.device)
+    valid = (cols[None, None, :] < sizes[:, 0, None, None]) & (rows[None, :, None] < sizes[:, 1, None, None])
+    return rows, cols, valid
+
+  def select(self, keep):
+    index = torch.arange(len(self), device=self.device)[keep.to(self.device)]
+    return InstanceMasks(self.boxes[index], self.data[self.positions(index)], self.height, self.width)
+
+  def pixels(self):
+    position = torch.nonzero(self.data).flatten()
+    k = torch.searchsorted(self.offsets, position, right=True) - 1
+    local = position - self.offsets[k]
+    widths = self.sizes[k, 0]
+    r, c = local // widths, local % widths
+    return k, r, c, (self.boxes[k, 1] + r) * self.width + self.boxes[k, 0] + c
+
+  def resolve_overlaps(self):
+    k, r, c, flat = self.pixels()
+    if len(flat) == 0:
+      return self
+    order = torch.argsort(flat * (len(self) + 1) + k)
+    flat = flat[order]
+    covered = torch.zeros_like(flat, dtype=torch.bool)
+    covered[:-1] = flat[1:] == flat[:-1]
+    if not covered.any():
+      return self
+    order = order[covered]
+    data = self.data.clone()
+    data[self.offsets[k[order]] + r[order] * self.sizes[k[order], 0] + c[order]] = False
+    return InstanceMasks(self.boxes, data, self.height, self.width)
+
+  def coordinates(self):
+    k, _, _, flat = self.pixels()
+    return k, flat
+
+  def areas(self):
+    counts = torch.cat((torch.zeros(1, dtype=torch.long, device=self.device), torch.cumsum(self.data.long(), 0)))
+    return counts[self.offsets[1:]] - counts[self.offsets[:-1]]
+
+  def box_masks(self, size):
+    result = torch.zeros((len(self), size, size), dtype=torch.bool, device=self.device)
+    for index in size_buckets(self.sizes):
+      index = torch.tensor(index, device=self.device)
+      _, _, valid = self.bucket_grid(index)
+      padded = torch.zeros(valid.shape, dtype=torch.float, device=self.device)
+      padded[valid] = self.data[self.positions(index)].float()
+      sizes = self.sizes[index].float()
+      rois = torch.cat((torch.arange(len(index), device=self.device)[:, None].float(),
+                        torch.zeros_like(sizes), sizes), dim=1)
+      result[index] = roi_align(padded[:, None], rois, output_size=size, sampling_ratio=-1, aligned=True)[:, 0] >= 0.5
+    return result
+
+  def to_label_image(self):
+    assert len(self) < 2**16, "too many instances for a uint16 label image"
+    k, flat = self.coordinates()
+    label = torch.zeros(self.height * self.width, dtype=torch.int32, device=self.device)
+    label[flat] = (k + 1).int()
+    return label.view(self.height, self.width).cpu().numpy().astype(np.uint16)
+
+  def render(self, scale=1.):
+    height, width = int(self.height * scale), int(self.width * scale)
+    k, r, c, _ = self.pixels()
+    ys = ((self.boxes[k, 1] + r) * scale).long().clamp(max=height - 1)
+    xs = ((self.boxes[k, 0] + c) * scale).long().clamp(max=width - 1)
+    image = torch.zeros(height * width, dtype=torch.float, device=self.device)
+    image[ys * width + xs] = (k + 1).float() * 255. / max(len(self), 1)
+    return image.view(height, width).cpu().numpy()
+
+  def rle_encode(self):
+    k, flat = self.coordinates()
+    if len(flat) == 0:
+      return {}
+    # a run ends where the instance changes or the next pixel is not the following index
+    start = torch.ones_like(flat, dtype=torch.bool)
+    start[1:] = (k[1:] != k[:-1]) | (flat[1:] != flat[:-1] + 1)
+    starts = torch.nonzero(start).flatten()
+    lengths = torch.diff(torch.cat((starts, torch.tensor([len(flat)], device=flat.device))))
+    runs = torch.stack((flat[starts], lengths), dim=1).cpu().numpy()
+    ids = (k[starts] + 1).cpu().numpy()
+    values, first = np.unique(ids, return_index=True)
+    bounds = np.append(first, len(ids))
+    return {values[j].item(): ' '.join(map(str, runs[bounds[j]:bounds[j+1]].ravel().tolist())) for j in range(len(values))}
 
-def get_prediction_mask(data, bool = False):
-  image = cv2.imread(data['file_name'])
+'''
+# IoU of two InstanceMasks of the same scene: the foreground IoU and the (K_pred, K_true) IoU matrix of the instances.
+# Both are computed from the sorted pixel indices, the pixels of a prediction are looked up in the ground truth.
+'''
+def instance_iou(pred, true):
+  pred_k, pred_flat = pred.coordinates()
+  true_k, true_flat = true.coordinates()
+  true_flat, order = torch.sort(true_flat)
+  true_k = true_k[order]
+  position = torch.searchsorted(true_flat, pred_flat).clamp(max=max(len(true_flat) - 1, 0))
+  hit = true_flat[position] == pred_flat if len(true_flat) > 0 else torch.zeros_like(pred_flat, dtype=torch.bool)
+
+  intersection = torch.bincount(pred_k[hit] * len(true) + true_k[position[hit]],
+                                minlength=len(pred) * len(true)).view(len(pred), len(true))
+  union = pred.areas()[:, None] + true.areas()[None, :] - intersection
+  matrix = intersection / union.clamp(min=1)
+  foreground_union = len(pred_flat) + len(true_flat) - int(hit.sum())
+  foreground = int(hit.sum()) / foreground_union if foreground_union > 0 else 0.
+  return foreground, matrix
+
+'''
+# Batched crop segmentation
+# The boxes of one or more images are cropped and resized to the 128*128 input of MyModel with roi_align,
+# segmented and pasted back as one InstanceMasks per input image.
+# The boxes are cropped, aligned and segmented in chunks of batch_size over all the images, and only the box regions
+# of a chunk (plus a margin for the bilinear sampling) are cut on the host and copied to the device as uint8, so
+# the host and device buffers depend on batch_size and the box sizes and not on the scene size or the box count. The margin repeats the border
+# pixels past the image edge, which is how roi_align clamps its samples, so the crops are the same as from the
+# whole image.
+# resolve = False keeps the pixels where the instances overlap in all of them (see Result cache).
+# boxes are (x0, y0, x1, y1) tensors in image coordinates and the instance ids are 1..K in the order of the boxes.
+'''
+from torchvision.ops import roi_align
+
+def paste_instance_masks(logits, boxes, height, width, threshold=0., resolve=True):
+  device = boxes.device
+  if len(boxes) == 0:
+    return InstanceMasks.empty(height, width, device)
+
+  # sample every box at its own size from the 128*128 prediction, in bbox-local coordinates, one bucket of similar
+  # box sizes at a time
+  boxes = boxes.long()
+  sizes = (boxes[:, 2:] - boxes[:, :2]).clamp(min=1)
+  boxes = torch.cat((boxes[:, :2], boxes[:, :2] + sizes), dim=1)
+  masks = InstanceMasks(boxes, torch.zeros(int(sizes.prod(1).sum()), dtype=torch.bool, device=device), height, width)
+  for index in size_buckets(sizes):
+    index = torch.tensor(index, device=device)
+    rows, cols, valid = masks.bucket_grid(index)
+    grid_x = (cols[None, :] + 0.5) / sizes[index, 0:1] * 2 - 1
+    grid_y = (rows[None, :] + 0.5) / sizes[index, 1:2] * 2 - 1
+    grid = torch.stack((grid_x[:, None, :].expand(-1, len(rows), -1),
+                        grid_y[:, :, None].expand(-1, -1, len(cols))), dim=3)
+    local = F.grid_sample(logits[index].float(), grid, mode='nearest', align_corners=False)[:, 0] > threshold
+    # the parts of the boxes outside of the image are dropped
+    ys = boxes[index, 1:2] + rows[None, :]
+    xs = boxes[index, 0:1] + cols[None, :]
+    local &= ((ys >= 0) & (ys < height))[:, :, None] & ((xs >= 0) & (xs < width))[:, None, :]
+    masks.data[masks.positions(index)] = local[valid]
+  # the highest id wins where the instances overlap
+  return masks.resolve_overlaps() if resolve else masks
+
+def crop_box_regions(image, boxes, margin=2):
+  boxes = boxes.long().cpu().numpy()
+  sizes = np.maximum(boxes[:, 2:] - boxes[:, :2], 0) + 2 * margin
+  regions = np.zeros((len(boxes), sizes[:, 1].max(), sizes[:, 0].max(), 3), dtype=np.uint8)
+  height, width = image.shape[:2]
+  # top down and with plain slices, so that image can be a SceneReader, the pixels outside the image repeat its edge
+  for k in np.argsort(boxes[:, 1], kind='stable'):
+    rows = np.clip(np.arange(boxes[k, 1] - margin, boxes[k, 1] - margin + sizes[k, 1]), 0, height - 1)
+    cols = np.clip(np.arange(boxes[k, 0] - margin, boxes[k, 0] - margin + sizes[k, 0]), 0, width - 1)
+    inside = image[rows[0]:rows[-1]+1, cols[0]:cols[-1]+1]
+    regions[k, :sizes[k, 1], :sizes[k, 0]] = inside[(rows - rows[0])[:, None], (cols - cols[0])[None, :]]
+  # the boxes in the coordinates of their region, with the index of the region in front
+  rois = np.concatenate((np.arange(len(boxes))[:, None], np.full((len(boxes), 2), margin),
+                         margin + sizes - 2 * margin), axis=1)
+  return regions, rois
+
+def segment_crops(images, boxes_list, size=128, batch_size=256, resolve=True):
+  device = DEVICE
+  # the (image, box) pairs go top down within every image, so that a SceneReader reads each band once
+  pairs = [(i, k) for i, boxes in enumerate(boxes_list)
+           for k in torch.argsort(boxes[:, 1].cpu(), stable=True).tolist()]
+  logits = [[None] * len(boxes) for boxes in boxes_list]
+  if pairs:
+    profiler.count('instances', len(pairs))
+  for start in range(0, len(pairs), batch_size):
+    chunk = pairs[start:start+batch_size]
+    crops = []
+    with profiler.timer('crop'):
+      for i in dict.fromkeys(i for i, _ in chunk):
+        index = torch.tensor([k for j, k in chunk if j == i])
+        regions, rois = crop_box_regions(images[i], boxes_list[i][index.to(boxes_list[i].device)])
+        regions = torch.from_numpy(regions).to(device).permute(0, 3, 1, 2).float()
+        rois = torch.from_numpy(rois).to(device).float()
+        crops.append(roi_align(regions, rois, output_size=size, sampling_ratio=-1, aligned=True))
+    with torch.inference_mode(), profiler.timer('segment'):
+      chunk_logits = model(torch.cat(crops).contiguous(memory_format=MEMORY_FORMAT))
+    for (i, k), logits_k in zip(chunk, chunk_logits):
+      logits[i][k] = logits_k
+
+  masks = []
+  for image, boxes, logits_i in zip(images, boxes_list, logits):
+    with profiler.timer('paste'):
+      masks.append(paste_instance_masks(torch.stack(logits_i) if logits_i else None, boxes.to(device),
+                                        image.shape[0], image.shape[1], resolve=resolve))
+  return masks
+
+'''
+# tile_size = None runs the detector over the whole image, otherwise get_tiled_predictions is used
+# for the images which are larger than a single tile. The images rejected by tile_filter get no boxes.
+# A tiled image is returned as its SceneReader.
+'''
+
+def get_prediction_mask(data, bool = False, tile_size = TILE_SIZE, overlap = TILE_OVERLAP, tile_filter = None):
+  if not bool and tile_size is not None and max(data['height'], data['width']) > tile_size:
+    image = SceneReader(data['file_name'], data['height'], data['width'], tile_size)
+  else:
+    with profiler.timer('decode'):
+      image = image_cache.read(data['file_name'])
   if bool:
-    maskdata = np.zeros([data['height'], data['width']])
-    for i,j in enumerate(data['annotations']):
-      bbox = j['bbox']
-      x,y,w,h = bbox
-      x = int(x)
-      y = int(y)
-      w = int(w)
-      h = int(h)
-      cropmask = image[y:y+h, x:x+w]
-      cropmask = torch.tensor(cropmask, dtype=torch.float, device=torch.device('cuda'), requires_grad = True).unsqueeze(1)
-      cropmask = torch.permute(cropmask, (1,3,0,2))
-      predicted_mask = model(cropmask)
-      
-      predicted_mask = predicted_mask.squeeze(1)
-      #cv2_imshow((predicted_mask*50).cpu().detach().permute(1,2,0).numpy())
-      predicted_mask[predicted_mask<0] = 0
-      predicted_mask[predicted_mask>0] = 1
-      predicted_mask = torch.floor(predicted_mask)
-      predicted_mask = predicted_mask.int()
-      predicted_mask = predicted_mask[0].cpu().detach().numpy()
-      predicted_mask = np.rint((predicted_mask))*(i+1) 
-      #cv2_imshow(predicted_mask*30)
-      predicted_mask = cv2.resize(predicted_mask, (w,h))
-      maskdata[y:y+h, x:x+w] = predicted_mask  
+    boxes = torch.tensor([[int(x), int(y), int(x) + int(w), int(y) + int(h)]
+                          for x, y, w, h in [j['bbox'] for j in data['annotations']]]).view(-1, 4)
 
   else:
     
-    predictionImg = predictor(image)['instances'].pred_boxes
-    maskdata = np.zeros([data['height'], data['width']])
-
-    for i in range(len(predictionImg)):
-      bbox = np.floor(predictionImg.tensor.cpu().numpy())
-      print(bbox)
-      x = int(bbox[i][0])
-      y = int(bbox[i][1])
-      w = int(bbox[i][2])
-      h = int(bbox[i][3])
-      cropmask = image[y:h, x:w]
-      cv2_imshow(cropmask)
-      cropmask = torch.tensor(cropmask, dtype=torch.float, device=torch.device('cuda'), requires_grad = True).unsqueeze(1)
-      cropmask = torch.permute(cropmask, (1,3,0,2))
-      predicted_mask = model(cropmask)
-      predicted_mask = predicted_mask.squeeze(1)
-      predicted_mask[predicted_mask<0] = 0
-      predicted_mask[predicted_mask>0] = 1
-      predicted_mask = torch.floor(predicted_mask)
-      predicted_mask = predicted_mask.int()
-      #cv2_imshow((predicted_mask*255).cpu().detach().permute(1,2,0).numpy())
-      predicted_mask = predicted_mask[0].cpu().detach().numpy()
-      predicted_mask = np.rint((predicted_mask))*(i+1) 
-      predicted_mask = cv2.resize(predicted_mask, (w-x,h-y))
-      maskdata[y:h, x:w] = predicted_mask
-    gt_mask = np.zeros([data['height'], data['width']])
+    if tile_size is not None and max(image.shape[:2]) > tile_size:
+      predictionImg = Boxes(get_tiled_predictions(image, tile_size, overlap, tile_filter=tile_filter)[0])
+    elif tile_filter is not None and not tile_filter.accept_images([image])[0]:
+      predictionImg = Boxes(torch.zeros((0, 4)))
+    else:
+      profiler.count('images')
+      with profiler.timer('detect'):
+        predictionImg = predictor(image)['instances'].pred_boxes
+    boxes = torch.floor(predictionImg.tensor)
 
-    
-  for i, j in enumerate(data['annotations']):
-    bbox = j['bbox']
-    x,y,w,h = [int(j) for j in bbox]
-    h = h+y
-    w = w+x
-    local_gt_mask = detectron2.utils.visualizer.GenericMask(j['segmentation'], data['height'], data['width']).mask
-    overlapping = np.maximum(gt_mask[y:h, x:w],local_gt_mask[y:h, x:w]*(i+1))
-    gt_mask[y:h, x:w] = overlapping
+  maskdata = segment_crops([image], [boxes])[0]
+  return to_prediction_tensors(data, image, maskdata)
 
-    
+def to_prediction_tensors(data, image, maskdata):
+  gt_mask = InstanceMasks.from_annotations(data, maskdata.device)
+
+  return image, gt_mask, maskdata # gt_mask has no instances when the ground truth is not given.
+
+'''
+# Same as get_prediction_mask for a whole list of samples, the detector and the segmentation model run on
+# batch_size images at a time and the images of the next batch are decoded in the background.
+# Yields (data, (image, gt_mask, pred_mask)) in the order of data_list.
+'''
 
-  image = torch.tensor(image, dtype=torch.float, device=torch.device('cuda'), requires_grad = True)
-  gt_mask = torch.tensor(gt_mask, dtype=torch.float, device=torch.device('cuda'), requires_grad = True)
-  maskdata = torch.tensor(maskdata, dtype=torch.float, device=torch.device('cuda'), requires_grad = True)
+def get_prediction_masks(data_list, batch_size = 4, detector = None):
+  batch_predictor = TiledPredictor(detector if detector is not None else predictor, batch_size)
+  start = 0
+  for images, outputs in batch_predictor.iter_batches([data['file_name'] for data in data_list]):
+    batch = data_list[start:start+len(images)]
+    start += len(images)
+    boxes = [torch.floor(output['instances'].pred_boxes.tensor) for output in outputs]
+    for data, image, maskdata in zip(batch, images, segment_crops(images, boxes)):
+      yield data, to_prediction_tensors(data, image, maskdata)
 
-  return image, gt_mask, maskdata # gt_mask could be all zero when the ground truth is not given.
+'''
+# Throughput of the detector + MyModel pipeline on DEVICE, once for every number of intra-op threads in
+# thread_counts (on the cpu, to choose NUM_THREADS)
+'''
+
+def benchmark_prediction(data_list, num_images = 20, batch_size = 4, thread_counts = None):
+  data_list = data_list[:num_images]
+  num_threads = torch.get_num_threads()
+  for threads in (thread_counts or [num_threads]):
+    torch.set_num_threads(threads)
+    image_cache.clear()
+    start = time.perf_counter()
+    for _ in get_prediction_masks(data_list, batch_size):
+      pass
+    elapsed = time.perf_counter() - start
+    print("{} ({} threads): {} images in {:.2f}s, {:.2f} images/s".format(
+        DEVICE, threads, len(data_list), elapsed, len(data_list) / elapsed))
+  torch.set_num_threads(num_threads)
 
 d = get_detection_data("train")
+total_iou = 0
 for i in tqdm(d):
-  get_prediction_mask(i, False)
+  _, true_mask, pred_mask = get_prediction_mask(i, False)
+  total_iou += instance_iou(pred_mask, true_mask)[0]
+print("Mean IoU of the scenes: {:.4f}".format(total_iou / len(d)))
+if RUN_BENCHMARKS:
+  benchmark_prediction(d)
+
+"""### Mask head on the detector features"""
+
+'''
+# Instead of cropping the raw pixels of every box and running the MyModel encoder on each crop, FeatureMaskPredictor
+# runs the detector once and ROI-aligns 256*14*14 features of all its boxes at once from the FPN levels of the
+# backbone (ROIPooler picks the level of every box by its size, like the Mask R-CNN mask head does).
+# FeatureMaskHead decodes them with the conv / up modules of MyModel into 28*28 logits, which are pasted with
+# paste_instance_masks like the MyModel crops. The head is trained on the ground truth boxes with the detector frozen.
+# run() returns {'instances': ..., 'pred_masks': InstanceMasks} per image, so iter_batches works as for BatchPredictor.
+# resolve = False keeps the overlapping pixels in all the instances, like segment_crops (see Result cache).
+# USE_FEATURE_HEAD = True makes the submission use the head. The head is only trained when it is used (or for the
+# benchmarks), and it is loaded from output/feature_mask_head.pth when that exists, delete it to train it again.
+'''
+from detectron2.modeling.poolers import ROIPooler
+
+USE_FEATURE_HEAD = False
+
+class FeatureMaskHead(nn.Module):
+  def __init__(self, in_ch=256):
+    super(FeatureMaskHead, self).__init__()
+    self.layer = nn.Sequential(
+        conv(in_ch, 128),
+        conv(128, 64),
+        up(64, 32),
+        conv(32, 1, False)
+        )
+
+  def forward(self, x):
+    return self.layer(x)
+
+class FeatureMaskPredictor(BatchPredictor):
+  def __init__(self, predictor, head, batch_size=4, num_workers=4, resolution=14):
+    super(FeatureMaskPredictor, self).__init__(predictor, batch_size, num_workers)
+    self.head = head
+    self.in_features = self.model.roi_heads.in_features
+    shapes = self.model.backbone.output_shape()
+    self.pooler = ROIPooler(resolution, tuple(1. / shapes[f].stride for f in self.in_features), 0, 'ROIAlignV2')
+    self.resolve = True
+
+  def features(self, inputs):
+    images = self.model.preprocess_image(inputs)
+    return images, self.model.backbone(images.tensor)
+
+  def pool(self, features, boxes):
+    return self.pooler([features[f] for f in self.in_features], boxes).contiguous(memory_format=MEMORY_FORMAT)
+
+  def run(self, inputs):
+    self.model.eval()
+    self.head.eval()
+    profiler.count('images', len(inputs))
+    with torch.inference_mode():
+      with profiler.timer('detect'):
+        images, features = self.features(inputs)
+        proposals, _ = self.model.proposal_generator(images, features, None)
+        instances, _ = self.model.roi_heads(images, features, proposals, None)
+      boxes = [i.pred_boxes for i in instances]
+      with profiler.timer('segment'):
+        logits = self.head(self.pool(features, boxes))
+
+    outputs = []
+    start = 0
+    for inputs_i, image_size, instances_i in zip(inputs, images.image_sizes, instances):
+      # the boxes are in the coordinates of the resized input image
+      scale = torch.tensor([inputs_i['width'] / image_size[1], inputs_i['height'] / image_size[0]] * 2,
+                           device=logits.device)
+      original = torch.floor(instances_i.pred_boxes.tensor * scale)
+      with profiler.timer('paste'):
+        masks = paste_instance_masks(logits[start:start+len(original)], original, inputs_i['height'], inputs_i['width'],
+                                     resolve=self.resolve)
+      outputs.append({'instances': instances_i, 'pred_masks': masks})
+      start += len(original)
+    return outputs
+
+'''
+# Training of the head on the ground truth boxes, the targets are the annotation masks ROI-aligned to 28*28
+'''
+def train_feature_mask_head(feature_predictor, data_list, num_epochs=10, batch_size=4, learning_rate=0.01):
+  head = feature_predictor.head.to(DEVICE, memory_format=MEMORY_FORMAT)
+  feature_predictor.model.eval()
+  head_optim = torch.optim.SGD(head.parameters(), lr=learning_rate, momentum=0.9, weight_decay=1e-5)
+  crit = nn.BCEWithLogitsLoss()
+  size = 2 * feature_predictor.pooler.output_size[0]
+  for epoch in range(num_epochs):
+    head.train()
+    total_loss = 0
+    batches = [data_list[k:k+batch_size] for k in range(0, len(data_list), batch_size)]
+    for batch in tqdm(batches):
+      inputs = [feature_predictor.load(data['file_name'])[1] for data in batch]
+      boxes, targets = [], []
+      for data, inputs_i in zip(batch, inputs):
+        true = InstanceMasks.from_annotations(data)
+        scale = torch.tensor([inputs_i['image'].shape[2] / inputs_i['width'],
+                              inputs_i['image'].shape[1] / inputs_i['height']] * 2, device=DEVICE)
+        boxes.append(Boxes(true.boxes.float() * scale))
+        targets.append(true.box_masks(size))
+      with torch.no_grad():
+        _, features = feature_predictor.features(inputs)
+        pooled = feature_predictor.pool(features, boxes)
+      loss = crit(head(pooled), torch.cat(targets).float()[:, None])
+      head_optim.zero_grad()
+      loss.backward()
+      head_optim.step()
+      total_loss += loss.item()
+    print("Epoch: {}, Loss: {}".format(epoch, total_loss / len(batches)))
+  return head
+
+'''
+# Latency per image and mean scene IoU of the crop + MyModel path, the feature head and Mask R-CNN on the same images.
+# The masks are collected first and compared with the ground truth after the timing.
+'''
+def benchmark_mask_paths(data_list, detector, mask_rcnn, feature_predictor, batch_size=4):
+  filenames = [data['file_name'] for data in data_list]
+  paths = {
+      'crop + MyModel': lambda: [masks for _, (_, _, masks) in get_prediction_masks(data_list, batch_size, detector)],
+      'FPN features + head': lambda: [output['pred_masks'] for _, outputs in feature_predictor.iter_batches(filenames)
+                                      for output in outputs],
+      'Mask R-CNN': lambda: [InstanceMasks.from_full_masks(output['instances'].pred_masks)
+                             for _, outputs in BatchPredictor(mask_rcnn, batch_size).iter_batches(filenames)
+                             for output in outputs],
+  }
+  for name, run in paths.items():
+    image_cache.clear() # every path decodes its images
+    start = time.perf_counter()
+    predictions = run()
+    if DEVICE.type == 'cuda':
+      torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    iou = [instance_iou(pred, InstanceMasks.from_annotations(data, pred.device))[0]
+           for data, pred in zip(data_list, predictions)]
+    print("{:20s}: {:8.1f} ms/image, Mean IoU {:.4f}".format(name, 1000 * elapsed / len(data_list), np.mean(iou)))
+
+detector = predictor # Part 4 replaces predictor with Mask R-CNN
+feature_head = FeatureMaskHead().to(DEVICE, memory_format=MEMORY_FORMAT)
+feature_predictor = FeatureMaskPredictor(detector, feature_head)
+feature_head_path = '{}/output/feature_mask_head.pth'.format(BASE_DIR)
+if USE_FEATURE_HEAD or RUN_BENCHMARKS:
+  if os.path.exists(feature_head_path):
+    feature_head.load_state_dict(torch.load(feature_head_path, map_location=DEVICE))
+  else:
+    train_feature_mask_head(feature_predictor, get_detection_data("train"))
+    torch.save(feature_head.state_dict(), feature_head_path)
+
+"""### Tile pre-filter"""
+
+'''
+# Most map tiles contain no airplane, so a small classifier in the style of the CIFAR BaseNet conv stack looks at every
+# tile (or whole image) downscaled to 128*128 first, and only the tiles it accepts are passed to the detector and MyModel.
+# The training tiles are cut from the train.json images with get_tile_origins, a tile is positive when it contains at
+# least half of the area of an annotated box. 20% of the images are held out, and the threshold is set on them to the
+# highest one which still keeps target_recall of the positive tiles.
+# TileFilter(tiles) returns one bool per tile, the numbers of tiles and of skipped tiles are counted by the profiler.
+# The threshold only holds for tiles of tile_size, so accept_images cuts the images into the same tiles and accepts
+# an image when any of its tiles is accepted (an image up to tile_size is a single tile, as in the training).
+# USE_TILE_FILTER = True makes the submission use the filter. It is only trained when it is used (or for the
+# benchmarks), and it is loaded from output/tile_filter.pth when that exists for the same tiling.
+'''
+class TileClassifier(nn.Module):
+  def __init__(self):
+    super(TileClassifier, self).__init__()
+    self.features = nn.Sequential(
+        conv(3, 32), nn.MaxPool2d(2),
+        conv(32, 64), nn.MaxPool2d(2),
+        conv(64, 128), nn.MaxPool2d(2),
+        conv(128, 128), nn.MaxPool2d(2),
+        conv(128, 256),
+        nn.AdaptiveMaxPool2d(1)
+        )
+    self.fc_net = nn.Sequential(
+        nn.Linear(256, 64),
+        nn.BatchNorm1d(64),
+        nn.ReLU(inplace=True),
+        nn.Linear(64, 1)
+        )
+
+  def forward(self, x):
+    x = self.features(x / 255.)
+    x = x.reshape(-1, 256)
+    return self.fc_net(x)[:, 0]
+
+def resize_tiles(tiles, size=128):
+  return np.stack([cv2.resize(tile, (size, size), interpolation = cv2.INTER_AREA) for tile in tiles])
+
+def get_tile_samples(data_list, tile_size=1024, overlap=128, size=128):
+  tiles, labels = [], []
+  # the images are decoded at full size and the tiles are resized by resize_tiles, the same way TileFilter resizes
+  # the full-resolution tiles of the scenes at inference
+  for data in tqdm(data_list):
+    image = read_image(data['file_name'])
+    boxes = np.array([a['bbox'] for a in data['annotations']], dtype=np.float64).reshape(-1, 4)
+    origins = get_tile_origins(data['height'], data['width'], tile_size, overlap)
+    tiles.append(resize_tiles([image[y:y+tile_size, x:x+tile_size] for x, y in origins], size))
+    for x, y in origins:
+      tile_w, tile_h = min(tile_size, data['width'] - x), min(tile_size, data['height'] - y)
+      w = np.clip(boxes[:, 0] + boxes[:, 2], x, x + tile_w) - np.clip(boxes[:, 0], x, x + tile_w)
+      h = np.clip(boxes[:, 1] + boxes[:, 3], y, y + tile_h) - np.clip(boxes[:, 1], y, y + tile_h)
+      labels.append(bool(np.any((w * h > 0) & (w * h >= 0.5 * boxes[:, 2] * boxes[:, 3]))))
+  return np.concatenate(tiles), np.array(labels)
+
+def get_tile_scores(model, tiles, batch_size=256):
+  model.eval()
+  scores = []
+  with torch.inference_mode():
+    for k in range(0, len(tiles), batch_size):
+      batch = torch.from_numpy(tiles[k:k+batch_size]).to(DEVICE).permute(0, 3, 1, 2).float()
+      scores.append(torch.sigmoid(model(batch.contiguous(memory_format=MEMORY_FORMAT))).cpu())
+  return torch.cat(scores) if scores else torch.zeros(0)
+
+def train_tile_classifier(tiles, labels, num_epochs=20, batch_size=64, learning_rate=0.001):
+  model = TileClassifier().to(DEVICE, memory_format=MEMORY_FORMAT)
+  optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+  # the positive tiles are the rare class
+  crit = nn.BCEWithLogitsLoss(pos_weight=torch.tensor((len(labels) - labels.sum()) / max(labels.sum(), 1), device=DEVICE))
+  tiles_t = torch.from_numpy(tiles)
+  labels_t = torch.from_numpy(labels).float()
+  for epoch in range(num_epochs):
+    model.train()
+    total_loss = 0
+    order = torch.randperm(len(tiles))
+    for k in range(0, len(tiles), batch_size):
+      index = order[k:k+batch_size]
+      if len(index) < 2: # BatchNorm1d needs more than one sample
+        continue
+      img = tiles_t[index].to(DEVICE).permute(0, 3, 1, 2).float().contiguous(memory_format=MEMORY_FORMAT)
+      loss = crit(model(img), labels_t[index].to(DEVICE))
+      optimizer.zero_grad()
+      loss.backward()
+      optimizer.step()
+      total_loss += loss.item()
+    print("Epoch: {}, Loss: {}".format(epoch, total_loss / max(len(tiles) // batch_size, 1)))
+  return model
+
+def get_recall_threshold(scores, labels, target_recall=0.99):
+  positive = torch.sort(scores[torch.from_numpy(labels)]).values
+  if len(positive) == 0:
+    return 0.
+  # the positives below the threshold are the ones the filter is allowed to lose
+  return positive[int(np.floor((1 - target_recall) * len(positive)))].item()
+
+class TileFilter:
+  def __init__(self, model, threshold, size=128, tile_size=1024, overlap=128):
+    self.model = model
+    self.threshold = threshold
+    self.size = size
+    self.tile_size = tile_size
+    self.overlap = overlap
+
+  def __call__(self, tiles):
+    with profiler.timer('tile_filter'):
+      keep = (get_tile_scores(self.model, resize_tiles(tiles, self.size)) >= self.threshold).tolist()
+    profiler.count('tiles', len(keep))
+    profiler.count('tiles_skipped', len(keep) - sum(keep))
+    return keep
+
+  def accept_images(self, images):
+    tiles, owners = [], []
+    for k, image in enumerate(images):
+      for x, y in get_tile_origins(image.shape[0], image.shape[1], self.tile_size, self.overlap):
+        tiles.append(image[y:y+self.tile_size, x:x+self.tile_size])
+        owners.append(k)
+    accepted = [False] * len(images)
+    for k, keep in zip(owners, self(tiles) if tiles else []):
+      accepted[k] = accepted[k] or keep
+    return accepted
+
+def get_tile_filter(data_list, target_recall=0.99, holdout=0.2, tile_size=1024, overlap=128):
+  data_list = list(data_list)
+  random.Random(0).shuffle(data_list)
+  split = int(len(data_list) * (1 - holdout))
+  tiles, labels = get_tile_samples(data_list[:split], tile_size, overlap)
+  model = train_tile_classifier(tiles, labels)
+
+  tiles, labels = get_tile_samples(data_list[split:], tile_size, overlap)
+  scores = get_tile_scores(model, tiles)
+  threshold = get_recall_threshold(scores, labels, target_recall)
+  keep = (scores >= threshold).numpy()
+  print("held-out tiles: {}, positive: {}, recall {:.4f}, skip rate {:.4f} at threshold {:.4f}".format(
+      len(labels), labels.sum(), keep[labels].mean() if labels.any() else 1., 1 - keep.mean(), threshold))
+  return TileFilter(model, threshold, tile_size=tile_size, overlap=overlap)
+
+'''
+# Skip rate and end-to-end speedup of the submission pipeline with the pre-filter on num_images test images
+'''
+def benchmark_tile_filter(data_list, tile_filter, num_images=50):
+  data_list = data_list[:num_images]
+  elapsed = []
+  # the skip rate is read from the tile counters, the state of the profiler is restored afterwards
+  saved = (profiler.enabled, profiler.timers, profiler.counters, profiler.events)
+  profiler.enabled = True
+  try:
+    for f in (None, tile_filter):
+      profiler.timers, profiler.counters, profiler.events = {}, {}, []
+      image_cache.clear()
+      start = time.perf_counter()
+      for _ in get_submission_pipeline(tile_filter=f).run(data_list):
+        pass
+      elapsed.append(time.perf_counter() - start)
+    skipped = profiler.counters.get('tiles_skipped', 0) / max(profiler.counters.get('tiles', 0), 1)
+  finally:
+    profiler.enabled, profiler.timers, profiler.counters, profiler.events = saved
+  print("{} images: skip rate {:.2%}, without filter {:.2f}s, with filter {:.2f}s, speedup {:.2f}x".format(
+      len(data_list), skipped, elapsed[0], elapsed[1], elapsed[0] / elapsed[1]))
+
+def load_tile_filter(path, tile_size, overlap):
+  if not os.path.exists(path):
+    return None
+  state = torch.load(path, map_location=DEVICE)
+  if (state['tile_size'], state['overlap']) != (tile_size, overlap):
+    return None
+  model = TileClassifier().to(DEVICE, memory_format=MEMORY_FORMAT)
+  model.load_state_dict(state['model'])
+  return TileFilter(model, state['threshold'], tile_size=tile_size, overlap=overlap)
+
+USE_TILE_FILTER = False
+tile_filter = None
+tile_filter_path = '{}/output/tile_filter.pth'.format(BASE_DIR)
+if USE_TILE_FILTER or RUN_BENCHMARKS:
+  tile_filter = load_tile_filter(tile_filter_path, TILE_SIZE or 1024, TILE_OVERLAP)
+  if tile_filter is None:
+    tile_filter = get_tile_filter(get_detection_data("train"), target_recall=0.99, tile_size=TILE_SIZE or 1024,
+                                  overlap=TILE_OVERLAP)
+    torch.save({'model': tile_filter.model.state_dict(), 'threshold': tile_filter.threshold,
+                'tile_size': tile_filter.tile_size, 'overlap': tile_filter.overlap}, tile_filter_path)
+
+"""### Result cache"""
+
+'''
+# Content-addressed cache of the Part 3 predictions, so unchanged images are not decoded, detected and segmented again.
+# The cache lookup is the first stage of the submission pipeline (see get_submission_pipeline).
+# The key is the sha1 of the image file bytes and of get_prediction_settings: the hash of the weights of the
+# detector and of the mask path (MyModel crops or the feature head), the detector settings which change the result
+# (input size, NMS, detections per image, tiling) and the weights and threshold of the tile filter.
+# The detector runs with the low raw_score_thresh and an entry keeps all its boxes with their scores and the
+# ragged bbox-local masks (InstanceMasks.data) before the overlaps are resolved, bit-packed, and the key also has
+# the CACHE_ENTRY_FORMAT of this layout. A higher score_thresh is applied when an entry is
+# read: the detector thresholds the scores before its NMS, and a box can only be suppressed by a box with a higher
+# score, so the boxes above score_thresh are the ones a run with score_thresh would find, in the same order.
+# The seam merge of a tiled scene does not rank by score alone (a low complete box can drop a high seam box), so
+# its entry keeps the boxes of all the tiles before the merge with their on_seam flags, and get_kept_boxes merges
+# the boxes above score_thresh when the entry is read, the same boxes in the same order as a run with score_thresh.
+# The entries are .npz files, a hit touches the mtime of its file, and when the directory grows over max_bytes the
+# least recently used entries are deleted. The sizes and the order of use are kept in memory, the mtimes only order
+# the entries of an earlier run when the cache is opened.
+'''
+import hashlib
+import io
+
+def get_model_hash(*models):
+  sha = hashlib.sha1()
+  for model in models:
+    if isinstance(model, torch.jit.ScriptModule):
+      buffer = io.BytesIO()
+      torch.jit.save(model, buffer)
+      sha.update(buffer.getvalue())
+    else:
+      for name, tensor in model.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+  return sha.hexdigest()
+
+class ResultCache:
+  def __init__(self, directory, max_bytes=2 * 2**30):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    os.makedirs(directory, exist_ok=True)
+    # the sizes of the entries from the least to the most recently used, kept in memory so that evict does not stat
+    # the directory, which other processes can change
+    entries = []
+    for name in os.listdir(directory):
+      path = os.path.join(directory, name)
+      try:
+        if name.endswith('.tmp'): # left over by a run which stopped during a put
+          os.remove(path)
+        elif name.endswith('.npz'):
+          entries.append((os.path.getmtime(path), name, os.path.getsize(path)))
+      except FileNotFoundError:
+        pass
+    self.sizes = OrderedDict((name, size) for _, name, size in sorted(entries))
+    self.hits = 0
+    self.misses = 0
+    # the pipeline threads read and write the cache at the same time
+    self.lock = threading.Lock()
+
+  def path(self, key):
+    return os.path.join(self.directory, key + '.npz')
+
+  def get(self, key):
+    path = self.path(key)
+    try:
+      os.utime(path)
+      with np.load(path) as entry:
+        entry = {name: entry[name] for name in entry.files}
+    except FileNotFoundError: # also when the entry is evicted in the meantime
+      with self.lock:
+        self.misses += 1
+      return None
+    with self.lock:
+      self.hits += 1
+      if key + '.npz' in self.sizes:
+        self.sizes.move_to_end(key + '.npz')
+    return entry
+
+  def put(self, key, **entry):
+    path = self.path(key)
+    with open(path + '.tmp', 'wb') as f:
+      np.savez_compressed(f, **entry)
+    os.replace(path + '.tmp', path)
+    size = os.path.getsize(path)
+    with self.lock:
+      self.sizes[key + '.npz'] = size
+      self.sizes.move_to_end(key + '.npz')
+      self.evict()
+
+  def evict(self):
+    total = sum(self.sizes.values())
+    while total > self.max_bytes and self.sizes:
+      name, size = self.sizes.popitem(last=False)
+      total -= size
+      try:
+        os.remove(os.path.join(self.directory, name))
+      except FileNotFoundError: # removed by someone else
+        pass
+
+  def stats(self):
+    return {"entries": len(self.sizes), "bytes": sum(self.sizes.values()), "hits": self.hits, "misses": self.misses}
+
+CACHE_ENTRY_FORMAT = 3 # part of the keys, so that the entries of an older layout are not read
+
+def to_cache_entry(masks, scores, tile_boxes=None, on_seam=None):
+  entry = {'boxes': masks.boxes.cpu().numpy().astype(np.int32), 'scores': scores.cpu().numpy().astype(np.float32),
+           'shape': np.array([masks.height, masks.width, len(masks.data)]),
+           'masks': np.packbits(masks.data.cpu().numpy())}
+  if on_seam is not None:
+    entry.update(tile_boxes=tile_boxes.cpu().numpy().astype(np.float32), on_seam=on_seam.cpu().numpy())
+  return entry
+
+def from_cache_entry(entry, score_thresh, device=DEVICE):
+  height, width, count = entry['shape'].tolist()
+  data = np.unpackbits(entry['masks'], count=count).astype(bool)
+  masks = InstanceMasks(torch.from_numpy(entry['boxes']).to(device), torch.from_numpy(data).to(device), height, width)
+  tiled = 'on_seam' in entry
+  keep = get_kept_boxes(torch.from_numpy(entry['scores']), score_thresh,
+                        torch.from_numpy(entry['tile_boxes']) if tiled else None,
+                        torch.from_numpy(entry['on_seam']) if tiled else None)
+  return masks.select(keep.to(device)).resolve_overlaps()
+
+'''
+# Everything which changes the predictions of the submission pipeline, as the result cache key and as the key of
+# the submission file. The feature head replaces MyModel and always runs on the whole scenes.
+'''
+def get_prediction_settings(score_thresh, feature_predictor=None, tile_filter=None):
+  detector = feature_predictor.model if feature_predictor is not None else predictor.model
+  settings = {'min_size': cfg.INPUT.MIN_SIZE_TEST, 'max_size': cfg.INPUT.MAX_SIZE_TEST,
+              'nms': cfg.MODEL.ROI_HEADS.NMS_THRESH_TEST, 'detections': cfg.TEST.DETECTIONS_PER_IMAGE,
+              'score_thresh': score_thresh}
+  if feature_predictor is not None:
+    settings.update(masks='feature head', models=get_model_hash(detector, feature_predictor.head))
+  else:
+    settings.update(masks='crop', models=get_model_hash(detector, model), tile_size=TILE_SIZE, overlap=TILE_OVERLAP)
+  if tile_filter is not None:
+    settings.update(tile_filter=get_model_hash(tile_filter.model), tile_filter_threshold=tile_filter.threshold,
+                    tile_filter_tile_size=tile_filter.tile_size, tile_filter_overlap=tile_filter.overlap)
+  return settings
 
 """### Visualization and Submission"""
 
@@ -633,22 +2270,17 @@ dataset = get_detection_data('train.json')
 for i in np.random.randint(0,50,5):
   img, true_mask, pred_mask = get_prediction_mask(dataset[i])
 
-  pred_mask = pred_mask.cpu().detach().numpy()
-  true_mask = true_mask.cpu().detach().numpy()
-  max_val = pred_mask.max()
-  fact = 255./max_val
-  pred_mask*= fact
-  max_val = true_mask.max()
-  fact = 255./max_val
-  true_mask*= fact
-  cv2_imshow(cv2.resize(img, (img.shape[1]//3, img.shape[0]//3), interpolation = cv2.INTER_AREA))
-  cv2_imshow(cv2.resize(true_mask, (true_mask.shape[1]//3, true_mask.shape[0]//3), interpolation = cv2.INTER_AREA))
+  # the masks are drawn directly at a third of the size, the image is the decoded one unless a tiled scene is read
+  # by bands
+  preview = img if isinstance(img, np.ndarray) else read_image(dataset[i]['file_name'], 2)
+  cv2_imshow(cv2.resize(preview, (img.shape[1]//3, img.shape[0]//3), interpolation = cv2.INTER_AREA))
+  cv2_imshow(true_mask.render(1/3))
   print("\n")
-  cv2_imshow(cv2.resize(pred_mask, (pred_mask.shape[1]//3, pred_mask.shape[0]//3), interpolation = cv2.INTER_AREA))
+  cv2_imshow(pred_mask.render(1/3))
 
 img, true_mask, pred_mask = get_prediction_mask(dataset[0])
 pred_file = open("{}/pred-test.csv".format(BASE_DIR), 'w')
-pd.DataFrame(pred_mask).to_csv(pred_file, index=False)
+pd.DataFrame(pred_mask.to_label_image()).to_csv(pred_file, index=False)
 pred_file.close()
 
 '''
@@ -664,74 +2296,468 @@ def rle_encoding(x):
     if(len(dots)==0):
       return []
     inds = torch.where(dots[1:]!=dots[:-1]+1)[0]+1
-    inds = torch.cat((torch.tensor([0], device=torch.device('cuda'), dtype=torch.long), inds))
+    inds = torch.cat((torch.tensor([0], device=x.device, dtype=torch.long), inds))
     tmpdots = dots[inds]
-    inds = torch.cat((inds, torch.tensor([len(dots)], device=torch.device('cuda'))))
+    inds = torch.cat((inds, torch.tensor([len(dots)], device=x.device)))
     inds = inds[1:] - inds[:-1]
     runs = torch.cat((tmpdots, inds)).reshape((2,-1))
     runs = torch.flatten(torch.transpose(runs, 0, 1)).cpu().data.numpy()
     return ' '.join([str(i) for i in runs])
 
+'''
+# Run-length encoding of all the instances of a label image in one sweep
+# The flattened label image is split into runs of equal values, the runs of the background are dropped and
+# the others are grouped by instance id with a stable sort, so every instance keeps its runs in pixel order.
+# Returns {instance id: 'start length start length ...'} with the same format as rle_encoding.
+# backend = 'torch' keeps the sweep on the device of the tensor, 'numpy' runs it on the cpu.
+# InstanceMasks are encoded from their foreground pixels without building the label image.
+'''
+
+def rle_encode_instances(label, backend = 'torch'):
+  if isinstance(label, InstanceMasks):
+    return label.rle_encode()
+  if backend == 'torch':
+    flat = torch.as_tensor(label).flatten()
+    change = torch.nonzero(flat[1:] != flat[:-1]).flatten() + 1
+    starts = torch.cat((torch.zeros(1, dtype=torch.long, device=flat.device), change))
+    lengths = torch.diff(torch.cat((starts, torch.tensor([len(flat)], device=flat.device))))
+    values = flat[starts]
+    foreground = values != 0
+    starts, lengths, values = starts[foreground], lengths[foreground], values[foreground]
+    values, order = torch.sort(values, stable=True)
+    runs = torch.stack((starts[order], lengths[order]), dim=1).cpu().numpy()
+    values = values.cpu().numpy()
+  else:
+    flat = (label.cpu().numpy() if torch.is_tensor(label) else np.asarray(label)).ravel()
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(flat)))
+    values = flat[starts]
+    foreground = values != 0
+    starts, lengths, values = starts[foreground], lengths[foreground], values[foreground]
+    order = np.argsort(values, kind='stable')
+    runs = np.stack((starts[order], lengths[order]), axis=1)
+    values = values[order]
+
+  ids, first = np.unique(values, return_index=True)
+  bounds = np.append(first, len(values))
+  return {ids[k].item(): ' '.join(map(str, runs[bounds[k]:bounds[k+1]].ravel().tolist())) for k in range(len(ids))}
+
+def rle_decode(encoded, shape):
+  mask = np.zeros(shape[0] * shape[1], dtype=bool)
+  runs = np.asarray(encoded.split(), dtype=np.int64).reshape(-1, 2)
+  for start, length in runs:
+    mask[start:start+length] = True
+  return mask.reshape(shape)
+
+def rle_decode_instances(encoded, shape):
+  label = np.zeros(shape[0] * shape[1], dtype=np.int32)
+  for index, rle in encoded.items():
+    runs = np.asarray(rle.split(), dtype=np.int64).reshape(-1, 2)
+    # one slice per run would be a python loop, so the run pixels are generated with a cumulative sum
+    offsets = np.repeat(runs[:, 0] - np.concatenate(([0], np.cumsum(runs[:, 1])[:-1])), runs[:, 1])
+    label[np.arange(len(offsets)) + offsets] = index
+  return label.reshape(shape)
+
+'''
+# Round-trip benchmark on a large synthetic label image with num_instances random ellipses
+'''
+
+def benchmark_rle(height = 4096, width = 4096, num_instances = 200, repeats = 1, device = "cpu"):
+  rng = np.random.default_rng(0)
+  label = np.zeros((height, width), dtype=np.int32)
+  for index in range(1, num_instances + 1):
+    center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+    axes = (int(rng.integers(5, 60)), int(rng.integers(5, 60)))
+    cv2.ellipse(label, center, axes, float(rng.uniform(0, 180)), 0, 360, index, -1)
+  tensor = torch.from_numpy(label).to(device)
+
+  def timed(fn):
+    start = time.perf_counter()
+    for _ in range(repeats):
+      result = fn()
+    return result, (time.perf_counter() - start) / repeats
+
+  per_instance, t_loop = timed(lambda: {index.item(): rle_encoding(tensor == index)
+                                        for index in torch.unique(tensor) if index != 0})
+  by_numpy, t_numpy = timed(lambda: rle_encode_instances(label, backend='numpy'))
+  by_torch, t_torch = timed(lambda: rle_encode_instances(tensor, backend='torch'))
+  decoded, t_decode = timed(lambda: rle_decode_instances(by_torch, label.shape))
+
+  assert per_instance == by_numpy == by_torch
+  assert (decoded == label).all()
+  print("{}x{}, {} instances: per instance {:.3f}s, numpy {:.3f}s, torch ({}) {:.3f}s, decode {:.3f}s".format(
+      height, width, len(by_torch), t_loop, t_numpy, device, t_torch, t_decode))
+
+if RUN_BENCHMARKS:
+  benchmark_rle()
+
+import queue
+
+'''
+# Pipelined inference engine
+# Every stage runs in its own pool of worker threads and the stages are connected by bounded queues, so a slow
+# stage makes the stages in front of it wait instead of letting the queues grow (the heavy work in cv2 and torch
+# releases the GIL, so the threads run in parallel).
+# A stage with batch_size > 1 gets a list of up to batch_size items which are waiting in its queue and returns
+# a list of results, otherwise it gets one item and returns one result.
+# stats() reports the number of items, the busy time and the current and max queue depth of every stage.
+# When the consumer of run() stops early (an exception in its loop or a closed generator) the stop event is set,
+# the threads leave their queue waits within poll_interval seconds and run() drains the queues before it returns.
+'''
+
+class PipelineStage:
+  def __init__(self, name, fn, num_workers=1, batch_size=1, queue_size=8):
+    self.name = name
+    self.fn = fn
+    self.num_workers = num_workers
+    self.batch_size = batch_size
+    self.queue = queue.Queue(queue_size)
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.items = 0
+    self.busy = 0.
+    self.max_depth = 0
+    self.remaining = self.num_workers
+
+class Pipeline:
+  DONE = object()
+
+  def __init__(self, stages, queue_size=8, poll_interval=0.1):
+    self.stages = stages
+    self.output = queue.Queue(queue_size)
+    self.errors = []
+    self.poll_interval = poll_interval
+    self.stop = threading.Event()
+
+  def put(self, out, item):
+    while not self.stop.is_set():
+      try:
+        out.put(item, timeout=self.poll_interval)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def get(self, q):
+    while not self.stop.is_set():
+      try:
+        return q.get(timeout=self.poll_interval)
+      except queue.Empty:
+        pass
+    return self.DONE
+
+  def get_batch(self, stage):
+    batch = [self.get(stage.queue)]
+    stage.max_depth = max(stage.max_depth, stage.queue.qsize() + 1)
+    while batch[-1] is not self.DONE and len(batch) < stage.batch_size:
+      try:
+        batch.append(stage.queue.get_nowait())
+      except queue.Empty:
+        break
+    return batch
+
+  def worker(self, k):
+    stage = self.stages[k]
+    last_stage = k + 1 == len(self.stages)
+    out = self.output if last_stage else self.stages[k+1].queue
+    while True:
+      batch = self.get_batch(stage)
+      done = batch[-1] is self.DONE
+      if done:
+        batch.pop()
+
+      # after an error the remaining items are only drained, so that every thread can finish
+      if batch and not self.errors:
+        start = time.perf_counter()
+        try:
+          results = stage.fn(batch) if stage.batch_size > 1 else [stage.fn(batch[0])]
+        except Exception as e:
+          self.errors.append(e)
+          results = []
+        with stage.lock:
+          stage.busy += time.perf_counter() - start
+          stage.items += len(batch)
+        for result in results:
+          if not self.put(out, result):
+            return
+
+      if self.stop.is_set():
+        return
+      if done:
+        with stage.lock:
+          stage.remaining -= 1
+          finished = stage.remaining == 0
+        if finished:
+          for _ in range(1 if last_stage else self.stages[k+1].num_workers):
+            self.put(out, self.DONE)
+        return
+
+  def feed(self, items):
+    for item in items:
+      if not self.put(self.stages[0].queue, item):
+        return
+    for _ in range(self.stages[0].num_workers):
+      self.put(self.stages[0].queue, self.DONE)
+
+  def drain(self):
+    for q in [stage.queue for stage in self.stages] + [self.output]:
+      while True:
+        try:
+          q.get_nowait()
+        except queue.Empty:
+          break
+
+  def run(self, items):
+    self.errors = []
+    self.stop.clear()
+    for stage in self.stages:
+      stage.reset()
+    threads = [threading.Thread(target=self.feed, args=(items,), daemon=True)]
+    for k, stage in enumerate(self.stages):
+      threads += [threading.Thread(target=self.worker, args=(k,), daemon=True) for _ in range(stage.num_workers)]
+    for thread in threads:
+      thread.start()
+
+    try:
+      while True:
+        result = self.output.get()
+        if result is self.DONE:
+          break
+        yield result
+    finally:
+      # also reached when the consumer stops early, the images and tensors in the queues are released
+      self.stop.set()
+      for thread in threads:
+        thread.join()
+      self.drain()
+    if self.errors:
+      raise self.errors[0]
+
+  def stats(self):
+    return {stage.name: {"items": stage.items,
+                         "busy_seconds": stage.busy,
+                         "seconds_per_item": stage.busy / max(stage.items, 1),
+                         "queue_depth": stage.queue.qsize(),
+                         "max_queue_depth": stage.max_depth} for stage in self.stages}
+
+'''
+# decode -> detect -> segment -> RLE encode, the rows are written by the loop consuming pipeline.run()
+# yields (data, [encoded pixels of every predicted instance])
+# with a FeatureMaskPredictor the masks come out of the detect stage and there is no segment stage
+# with a tile_filter only the tiles it accepts are passed to the detector, an image without any gets no instances
+# with a result_cache the decode stage looks every image up first, the hits skip the detect and segment stages and
+# the misses are stored by the encode stage. The items are dicts which the stages fill in.
+'''
+
+def get_submission_pipeline(batch_size = 4, decode_workers = 4, encode_workers = 2, feature_predictor = None,
+                            tile_filter = None, result_cache = None, raw_score_thresh = 0.05):
+  # the large scenes are tiled by the crop path, the feature head runs on the whole scenes
+  batch_predictor = feature_predictor if feature_predictor is not None else TiledPredictor(predictor, batch_size)
+  box_predictor = batch_predictor.model.roi_heads.box_predictor
+  score_thresh = box_predictor.test_score_thresh
+  raw_score_thresh = min(raw_score_thresh, score_thresh) if result_cache is not None else score_thresh
+  settings = get_prediction_settings(raw_score_thresh, feature_predictor, tile_filter)
+  prefix = json.dumps(dict(settings, entry_format=CACHE_ENTRY_FORMAT), sort_keys=True).encode()
+
+  def decode(data):
+    item = {'data': data, 'entry': None}
+    if result_cache is None:
+      item['image'], item['inputs'] = batch_predictor.load(data['file_name'])
+      return item
+    with open(data['file_name'], 'rb') as f:
+      content = f.read()
+    item['key'] = hashlib.sha1(prefix + content).hexdigest()
+    item['entry'] = result_cache.get(item['key'])
+    if item['entry'] is None:
+      # the file is read again from the page cache, a tiled scene is read by bands
+      item['image'], item['inputs'] = batch_predictor.load(data['file_name'])
+    return item
+
+  def detect(batch):
+    missing = [item for item in batch if item['entry'] is None]
+    if not missing:
+      return batch
+    # all the boxes down to raw_score_thresh, the masks before the overlaps are resolved and, for the cache, the
+    # boxes of the tiled scenes before the seams are merged, see encode
+    box_predictor.test_score_thresh = raw_score_thresh
+    if feature_predictor is not None:
+      feature_predictor.resolve = False
+    else:
+      batch_predictor.merge = result_cache is None
+    try:
+      outputs = batch_predictor.detect([item['image'] for item in missing], [item['inputs'] for item in missing],
+                                       tile_filter)
+    finally:
+      box_predictor.test_score_thresh = score_thresh
+      if feature_predictor is not None:
+        feature_predictor.resolve = True
+      else:
+        batch_predictor.merge = True
+    for item, output in zip(missing, outputs):
+      item['inputs'] = None
+      if output is None:
+        item['boxes'], item['scores'] = torch.zeros((0, 4)), torch.zeros(0)
+        item['masks'] = InstanceMasks.empty(*item['image'].shape[:2])
+      else:
+        item['boxes'] = torch.floor(output['instances'].pred_boxes.tensor)
+        item['scores'] = output['instances'].scores
+        if output['instances'].has('on_seam'):
+          item['tile_boxes'], item['on_seam'] = output['instances'].pred_boxes.tensor, output['instances'].on_seam
+        if 'pred_masks' in output:
+          item['masks'] = output['pred_masks']
+    return batch
+
+  def segment(batch):
+    missing = [item for item in batch if item['entry'] is None and 'masks' not in item]
+    masks = segment_crops([item['image'] for item in missing], [item['boxes'] for item in missing], resolve=False)
+    for item, masks_i in zip(missing, masks):
+      item['masks'] = masks_i
+    return batch
+
+  def encode(item):
+    if item['entry'] is not None:
+      pred_mask = from_cache_entry(item['entry'], score_thresh)
+    else:
+      masks = item['masks']
+      tile_boxes, on_seam = item.get('tile_boxes'), item.get('on_seam')
+      if result_cache is not None:
+        result_cache.put(item['key'], **to_cache_entry(masks, item['scores'], tile_boxes, on_seam))
+      keep = get_kept_boxes(item['scores'].cpu(), score_thresh, tile_boxes, on_seam)
+      pred_mask = masks.select(keep.to(masks.device)).resolve_overlaps()
+    with profiler.timer('rle'):
+      return item['data'], list(rle_encode_instances(pred_mask).values())
+
+  stages = [PipelineStage('decode', decode, num_workers=decode_workers),
+            PipelineStage('detect', detect, batch_size=batch_size)]
+  if feature_predictor is None:
+    stages.append(PipelineStage('segment', segment, batch_size=batch_size))
+  stages.append(PipelineStage('encode', encode, num_workers=encode_workers))
+  return Pipeline(stages)
+
+'''
+# The settings of the submission pipeline with the score_thresh of the detector, as the key of the submission file
+'''
+def get_submission_settings(feature_predictor = None, tile_filter = None):
+  detector = feature_predictor if feature_predictor is not None else predictor
+  score_thresh = detector.model.roi_heads.box_predictor.test_score_thresh
+  return get_prediction_settings(score_thresh, feature_predictor, tile_filter)
+
 '''
 #
 # The speed of your code in the previous parts highly affects the running time of this part
 '''
 
-preddic = {"ImageId": [], "EncodedPixels": []}
+'''
+# Streaming submission writer
+# The rows of an image are appended to the csv as soon as it is encoded and the file is flushed every
+# flush_interval seconds, so a crash only loses the last few images instead of everything.
+# With resume = True the ImageIds which are already in the file are skipped. The rows of the last image in the
+# file are removed first since they could be incomplete, so that image is predicted again.
+# key describes what produces the rows (model hashes and settings) and is stored in <path>.key.json, a file which
+# was written with a different key is started again instead of being resumed.
+'''
+
+class SubmissionWriter:
+  def __init__(self, path, flush_interval = 10., resume = True, key = None):
+    self.path = path
+    self.flush_interval = flush_interval
+    self.written = set()
+    key = json.dumps(key, sort_keys=True)
+    key_path = path + '.key.json'
+    same_key = False
+    if os.path.exists(key_path):
+      with open(key_path) as f:
+        same_key = f.read() == key
+    if resume and same_key and os.path.exists(path):
+      self.truncate_last_image()
+    else:
+      with open(path, 'w', newline='') as f:
+        csv.writer(f).writerow(["ImageId", "EncodedPixels"])
+      with open(key_path, 'w') as f:
+        f.write(key)
+    self.file = open(path, 'a', newline='')
+    self.writer = csv.writer(self.file)
+    self.last_flush = time.time()
+
+  def truncate_last_image(self):
+    with open(self.path, 'rb+') as f:
+      # anything after the last newline is a partially written row
+      lines = f.read().split(b'\n')[:-1]
+      if len(lines) == 0:
+        f.seek(0)
+        f.truncate()
+        f.write(b'ImageId,EncodedPixels\r\n')
+        return
+      image_ids = [line.split(b',', 1)[0].decode() for line in lines[1:]]
+      keep = len(image_ids)
+      while keep > 0 and image_ids[keep-1] == image_ids[-1]:
+        keep -= 1
+      f.truncate(sum(len(line) + 1 for line in lines[:keep+1]))
+      self.written = set(image_ids[:keep])
+
+  def __contains__(self, image_id):
+    return image_id in self.written
+
+  def write(self, image_id, encoded):
+    # an image without any prediction gets a single row with an empty list, like the DataFrame output
+    with profiler.timer('csv_write'):
+      for encPix in (encoded if len(encoded) > 0 else [[]]):
+        self.writer.writerow([image_id, encPix])
+    self.written.add(image_id)
+    if time.time() - self.last_flush > self.flush_interval:
+      self.flush()
+
+  def flush(self):
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    self.last_flush = time.time()
+
+  def close(self):
+    self.flush()
+    self.file.close()
+
+USE_RESULT_CACHE = True
+result_cache = ResultCache('{}/output/result_cache'.format(BASE_DIR)) if USE_RESULT_CACHE else None
+submission_feature_predictor = feature_predictor if USE_FEATURE_HEAD else None
+submission_tile_filter = tile_filter if USE_TILE_FILTER else None
+pipeline = get_submission_pipeline(feature_predictor=submission_feature_predictor, tile_filter=submission_tile_filter,
+                                   result_cache=result_cache)
+submission = SubmissionWriter("{}/pred.csv".format(BASE_DIR),
+                              key=get_submission_settings(submission_feature_predictor, submission_tile_filter))
+
+def get_remaining_samples(set_name):
+  my_data_list = DatasetCatalog.get("airplane_{}".format(set_name))
+  for sample in my_data_list:
+    sample['image_id'] = sample['file_name'].split("/")[-1][:-4]
+  return [sample for sample in my_data_list if sample['image_id'] not in submission]
 
 '''
 # Writing the predictions of the training set
 '''
 
-my_data_list = DatasetCatalog.get("airplane_{}".format('train'))
-for i in tqdm(range(len(my_data_list)), position=0, leave=True):
-  print(i)
-  sample = my_data_list[i]
-  sample['image_id'] = sample['file_name'].split("/")[-1][:-4]
-  img, true_mask, pred_mask = get_prediction_mask(sample)
-  
-  pred_file = open("{}/pred_mask.csv".format(BASE_DIR), 'w')
-  pd.DataFrame(preddic).to_csv(pred_file, index=False)
-  pred_file.close()
-  inds = torch.unique(pred_mask)
-  if(len(inds)==1):
-    preddic['ImageId'].append(sample['image_id'])
-    preddic['EncodedPixels'].append([])
-  else:
-    for index in inds:
-      if(index == 0):
-        continue
-      
-      tmp_mask = (pred_mask==index)
-      encPix = rle_encoding(tmp_mask)
-      preddic['ImageId'].append(sample['image_id'])
-      preddic['EncodedPixels'].append(encPix)
+my_data_list = get_remaining_samples('train')
+for sample, encoded in tqdm(pipeline.run(my_data_list), total=len(my_data_list), position=0, leave=True):
+  submission.write(sample['image_id'], encoded)
 
 '''
 # Writing the predictions of the test set
 '''
 
-my_data_list = DatasetCatalog.get("airplane_{}".format('test'))
-for i in tqdm(range(len(my_data_list)), position=0, leave=True):
-  sample = my_data_list[i]
-  sample['image_id'] = sample['file_name'].split("/")[-1][:-4]
-  img, true_mask, pred_mask = get_prediction_mask(sample)
-  inds = torch.unique(pred_mask)
-  if(len(inds)==1):
-    preddic['ImageId'].append(sample['image_id'])
-    preddic['EncodedPixels'].append([])
-  else:
-    for j, index in enumerate(inds):
-      if(index == 0):
-        continue
-      tmp_mask = (pred_mask==index).double()
-      encPix = rle_encoding(tmp_mask)
-      preddic['ImageId'].append(sample['image_id'])
-      preddic['EncodedPixels'].append(encPix)
+my_data_list = get_remaining_samples('test')
+if RUN_BENCHMARKS:
+  benchmark_tile_filter(my_data_list, tile_filter)
+for sample, encoded in tqdm(pipeline.run(my_data_list), total=len(my_data_list), position=0, leave=True):
+  submission.write(sample['image_id'], encoded)
+print(pipeline.stats())
+if result_cache is not None:
+  print(result_cache.stats())
 
-pred_file = open("{}/pred.csv".format(BASE_DIR), 'w')
-pd.DataFrame(preddic).to_csv(pred_file, index=False)
-pred_file.close()
+submission.close()
+print(json.dumps(profiler.summary(), indent=2))
+profiler.save_summary('{}/output/profile_summary.json'.format(BASE_DIR))
+profiler.save_trace('{}/output/profile_trace.json'.format(BASE_DIR))
 
 """## Part 4: Mask R-CNN
 
@@ -757,6 +2783,7 @@ cfg.SOLVER.IMS_PER_BATCH = 2
 cfg.SOLVER.MAX_ITER = 1000
 cfg.MODEL.ROI_HEADS.BATCH_SIZE_PER_IMAGE = 512   
 cfg.MODEL.ROI_HEADS.NUM_CLASSES = 1
+cfg.MODEL.DEVICE = DEVICE.type
 
 """### Training"""
 
@@ -766,15 +2793,22 @@ trainer = DefaultTrainer(cfg)
 cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.4
 predictor = DefaultPredictor(cfg)
 
+'''
+# Latency and IoU of the Part 3 paths (crop + MyModel, detector features + head) against Mask R-CNN
+'''
+if RUN_BENCHMARKS:
+  benchmark_mask_paths(data[:20], detector, predictor, feature_predictor)
+
 """### Evaluation and Visualization"""
 
 for i in random.sample(data_test, 3):
-  image = cv2.imread(i['file_name'])
+  scale = get_preview_scale(i)
+  image = read_image(i['file_name'], scale)
   output = predictor(image)
 
   v = Visualizer(image[:, :, ::-1],
                  metadata = plane_test_metadata,
-                 scale = 0.5)
+                 scale = 0.5 * scale)
   out = v.draw_instance_predictions(output['instances'].to('cpu'))
   cv2_imshow(out.get_image()[:, :, ::-1])
 